@@ -0,0 +1,71 @@
+"""Payload size and encode time of the bus_locations encodings.
+
+Usage: python bench_feed.py [--repeat N]
+"""
+import argparse, gzip, json, random, time
+
+from main import encode_fleet_binary, encode_fleet_columnar, fleet_static_version
+
+PHOTO_BASE = "https://bus-tracker.example.com"
+
+def make_fleet(count, seed=42):
+    rng = random.Random(seed)
+    fleet = []
+    for i in range(1, count + 1):
+        fleet.append({
+            'id': i,
+            'name': f"Driver {i}",
+            'phone': f"9198{rng.randrange(10 ** 8):08d}",
+            'photo': f"/uploads/driver_{i}.jpg" if rng.random() < 0.7 else "/static/default_profile.png",
+            'lat': 28.4 + rng.random() * 0.5,
+            'lon': 76.9 + rng.random() * 0.5,
+            'rating': round(rng.uniform(1, 5), 2) if rng.random() < 0.8 else None,
+            'eta_minutes': rng.randrange(90),
+            'last_updated': 1760000000 + rng.randrange(86400)
+        })
+    return fleet
+
+def legacy_json(fleet):
+    return json.dumps({'drivers': [{
+        'id': bus['id'],
+        'name': bus['name'],
+        'phone': bus['phone'],
+        'photo': PHOTO_BASE + bus['photo'],
+        'lat': bus['lat'],
+        'lon': bus['lon'],
+        'rating': bus['rating'],
+        'eta': f"{bus['eta_minutes']} mins" if bus['eta_minutes'] > 0 else "Arrived!",
+        'last_updated': time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(bus['last_updated']))
+    } for bus in fleet]}, separators=(",", ":"), sort_keys=True).encode("utf-8")
+
+def timed(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = fn()
+        best = min(best, time.perf_counter() - start)
+    return body, best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="runs per encoding; the best time is reported")
+    args = parser.parse_args()
+
+    print(f"{'buses':>6}  {'encoding':<22} {'bytes':>10} {'gzip':>10} {'encode ms':>10}")
+    for count in (100, 1000, 10000):
+        fleet = make_fleet(count)
+        version = fleet_static_version(fleet)
+        encodings = [
+            ("json (current)", lambda: legacy_json(fleet)),
+            ("columnar + static", lambda: encode_fleet_columnar(fleet, PHOTO_BASE, version, True)),
+            ("columnar", lambda: encode_fleet_columnar(fleet, PHOTO_BASE, version, False)),
+            ("binary + static", lambda: encode_fleet_binary(fleet, version, True)),
+            ("binary", lambda: encode_fleet_binary(fleet, version, False)),
+        ]
+        for name, fn in encodings:
+            body, seconds = timed(fn, args.repeat)
+            print(f"{count:>6}  {name:<22} {len(body):>10} {len(gzip.compress(body)):>10} {seconds * 1000:>10.2f}")
+        print()
+
+if __name__ == "__main__":
+    main()
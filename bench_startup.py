@@ -0,0 +1,51 @@
+"""Worker startup time: import, create_app() and the first request, each in a fresh interpreter.
+
+The first request is a parent login, so it opens the school database: on the
+cold run that includes creating the schema and hashing the demo passwords.
+
+Usage: python bench_startup.py [--repeat N]
+"""
+import argparse, json, os, subprocess, sys, tempfile
+
+PROBE = r"""
+import json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+app = main.create_app()
+created = time.perf_counter()
+status = app.test_client().post("/parent_login", data={'username': "parent1", 'password': "pass"}).status_code
+served = time.perf_counter()
+print(json.dumps({'import': imported - start, 'create_app': created - imported,
+                  'first_request': served - created, 'status': status}))
+"""
+
+def probe(env):
+    out = subprocess.run([sys.executable, "-c", PROBE], env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="warm starts to run; the best time is reported")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # A throwaway school database so the cold run really creates the schema
+        config = os.path.join(tmp, "schools.json")
+        with open(config, "w") as f:
+            json.dump({'default': {'name': "Bench", 'db': os.path.join(tmp, "bench.db")}}, f)
+        env = dict(os.environ, SCHOOLS_CONFIG=config)
+
+        print(f"{'run':<6} {'import ms':>10} {'create_app ms':>14} {'first request ms':>17} {'status':>7}")
+        runs = [("cold", probe(env))]
+        if not os.path.exists(os.path.join(tmp, "bench.db")):
+            sys.exit("The first request never opened the school database")
+        warm = [probe(env) for _ in range(args.repeat)]
+        runs.append(("warm", min(warm, key=lambda r: r['import'] + r['create_app'] + r['first_request'])))
+        for name, r in runs:
+            print(f"{name:<6} {r['import'] * 1000:>10.1f} {r['create_app'] * 1000:>14.1f} "
+                  f"{r['first_request'] * 1000:>17.1f} {r['status']:>7}")
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,75 @@
-from flask import Flask, request, redirect, url_for, render_template_string, session, jsonify, flash, g
+from flask import Flask, request, redirect, url_for, render_template, session, jsonify, flash, g, send_from_directory
+from jinja2 import DictLoader
 from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
-import sqlite3, os, logging, json
+import sqlite3, os, logging, json, threading, time, uuid, re, gzip, hashlib, struct, zlib, mimetypes
+import click
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from functools import wraps
 from math import radians, sin, cos, sqrt, atan2
 import urllib.parse
-from datetime import datetime
+from datetime import datetime, timezone, timedelta
 
 # ----------------------------
 # App configuration
 # ----------------------------
-app = Flask(__name__)
+# Static files are served by static_file() below so precompressed variants can be used
+app = Flask(__name__, static_folder=None)
 app.secret_key = "school_bus_tracker_secret"
 app.config['UPLOAD_FOLDER'] = os.path.join(os.path.abspath(os.path.dirname(__file__)), "uploads")
 app.config['MAX_CONTENT_LENGTH'] = 4 * 1024 * 1024  # 4 MB
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-os.makedirs(os.path.join(os.path.abspath(os.path.dirname(__file__)), "static"), exist_ok=True)
+# Number of reverse proxies in front of the app (1 for the Heroku-style router).
+# remote_addr is then the real client, which the per-address login limit keys on.
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", 1))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS)
 
 DB = os.path.join(os.path.abspath(os.path.dirname(__file__)), "bus.db")
+SHARD_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), "data")
+SCHOOLS_CONFIG = os.environ.get("SCHOOLS_CONFIG", os.path.join(os.path.abspath(os.path.dirname(__file__)), "schools.json"))
+SHARD_POOL_SIZE = 5  # idle connections kept per school database
+ARCHIVE_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), "archive")
+FLEET_CACHE_TTL_S = 2  # bus_locations is rebuilt at most once per interval per school
+# Canonical external URL used for photo links; when unset the request's Host is used
+PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", "").rstrip("/")
+FLEET_JSON_MIMETYPE = "application/json"
+FLEET_COLUMNAR_MIMETYPE = "application/vnd.bustracker.columnar+json"
+FLEET_BINARY_MIMETYPE = "application/vnd.bustracker.fleet"
+
+# Response compression
+COMPRESS_MIN_SIZE = 500  # bytes; smaller bodies are sent as-is
+COMPRESS_LEVEL = 6
+COMPRESS_BROTLI_QUALITY = 5
+COMPRESS_CACHE_BYTES = 8 * 1024 * 1024  # compressed bodies kept in memory, keyed by content hash
+COMPRESS_CACHE_MAX_BODY = 512 * 1024
+# Only bodies that repeat across requests are cached: public responses and these
+# endpoints (shared fleet snapshots and files). Per-user pages are compressed directly.
+COMPRESS_CACHE_ENDPOINTS = {"bus_locations", "static", "uploaded_file"}
+COMPRESSIBLE_MIMETYPES = {"text/html", "text/css", "text/plain", "text/javascript", "application/javascript",
+                          "application/json", "application/x-ndjson", "application/xml", "image/svg+xml"}
+PRECOMPRESS_EXTENSIONS = {".html", ".css", ".js", ".json", ".svg", ".txt", ".xml"}
+
+# Profile and dashboard cache. Each worker has its own copy, so entries are
+# checked against a per-user version in the school database (one primary-key
+# lookup per request) that every write path bumps.
+USER_CACHE_TTL_S = 300
+USER_CACHE_SIZE = 4096
+
+# Password hashing runs on a small bounded pool so a login rush cannot tie up
+# every request thread. Requests beyond workers + queue get a 429 straight away.
+# This only bounds anything with threaded workers (see procfile: gthread); a sync
+# worker serves one request at a time and could never fill the queue. Logins may
+# hold at most half of a worker's threads, so tracking requests always get the rest.
+WEB_THREADS = int(os.environ.get("WEB_THREADS", 8))  # must match gunicorn --threads
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt")
+LOGIN_HASH_WORKERS = max(min(2, WEB_THREADS // 2), 1)
+LOGIN_HASH_QUEUE = max(WEB_THREADS // 2 - LOGIN_HASH_WORKERS, 0)
+LOGIN_HASH_TIMEOUT_S = 5
+LOGIN_RATE_WINDOW_S = 5 * 60
+LOGIN_RATE_LIMIT_IP = int(os.environ.get("LOGIN_RATE_LIMIT_IP", 30))  # attempts per window from one address
+LOGIN_RATE_LIMIT_USERNAME = 10  # attempts per window against one account
 DEFAULT_PROFILE_IMG = "static/default_profile.png"
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif"}
 
@@ -27,6 +79,109 @@ ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif"}
 SCHOOL_LOCATION = {'lat': 28.6139, 'lon': 77.2090} # New Delhi
 AVERAGE_BUS_SPEED_KMPH = 30 
 BUS_NEAR_DISTANCE_KM = 0.5 # 500 meters for notification
+SCHOOL_ARRIVAL_TIME = "08:00"  # scheduled arrival, school local time
+SCHOOL_UTC_OFFSET_MIN = 330    # IST
+
+# Track history: simplification tolerance is expressed in screen pixels and
+# converted to meters for the requested map zoom level.
+TRACK_TOLERANCE_PX = 2
+TRACK_DEFAULT_ZOOM = 15
+TRACK_CACHE_SIZE = 256
+
+# GPS ingest filter: fixes that barely move are only stored once per heartbeat
+# window, and fixes implying an impossible speed are treated as GPS glitches.
+INGEST_MIN_MOVE_M = 15
+INGEST_HEARTBEAT_S = 120
+INGEST_MAX_SPEED_KMPH = float(os.environ.get("INGEST_MAX_SPEED_KMPH", 150))
+INGEST_SMOOTHING = os.environ.get("INGEST_SMOOTHING", "0") == "1"
+INGEST_KALMAN_Q = 3.0   # process noise, m^2 per second
+INGEST_DEFAULT_ACCURACY_M = 10
+INGEST_MAX_CLOCK_SKEW_S = 30  # client timestamps further than this from the server clock are ignored
+
+# Adaptive reporting: the server tells the driver client when to send the
+# next fix, aiming for roughly one fix per REPORT_DISTANCE_M while moving.
+REPORT_DISTANCE_M = 200
+REPORT_INTERVAL_MIN_S = 5
+REPORT_INTERVAL_MOVING_S = 30
+REPORT_INTERVAL_IDLE_S = 60
+REPORT_INTERVAL_OFF_SHIFT_S = 300
+REPORT_NEAR_SCHOOL_KM = 1.0
+REPORT_PARKED_KMPH = 3
+SERVICE_HOURS = (6, 18)  # local hours when buses are on shift
+
+# Trip analytics rollups
+TRIP_GAP_S = 20 * 60        # a longer silence between fixes ends the trip
+STOP_RADIUS_M = 50          # a bus staying within this radius is stopped...
+STOP_MIN_DWELL_S = 60       # ...once it has stayed at least this long
+ON_TIME_GRACE_MIN = 5
+
+# Data retention: rows older than this many days are moved out of the live
+# database into append-only archive/<school>/<table>-YYYY-MM.jsonl.gz files.
+RETENTION_DAYS = {
+    'locations': int(os.environ.get("RETENTION_LOCATIONS_DAYS", 90)),
+    'notifications': int(os.environ.get("RETENTION_NOTIFICATIONS_DAYS", 30)),
+    'feedback': int(os.environ.get("RETENTION_FEEDBACK_DAYS", 365)),
+    'complaints': int(os.environ.get("RETENTION_COMPLAINTS_DAYS", 365)),
+}
+RETENTION_TIME_COLUMNS = {'locations': 'recorded_at', 'notifications': 'created_at', 'feedback': 'timestamp', 'complaints': 'timestamp'}
+RETENTION_BATCH_SIZE = 5000
+
+# Parent notification outbox
+# "webhook" or "stub". Unset means notifications are disabled, except under
+# debug or testing where the stub is used.
+NOTIFY_TRANSPORT = os.environ.get("NOTIFY_TRANSPORT")
+NOTIFY_WEBHOOK_URL = os.environ.get("NOTIFY_WEBHOOK_URL")
+NOTIFY_DEDUPE_WINDOW_S = 30 * 60  # minimum gap between arrival messages to one parent for one bus
+NOTIFY_STUB_KEEP = 100  # messages the stub transport remembers
+NOTIFY_BATCH_SIZE = 5  # rows claimed at a time; kept small so a claim never outlives its sends
+NOTIFY_SEND_TIMEOUT_S = 10
+NOTIFY_POLL_S = 10
+NOTIFY_MAX_ATTEMPTS = 6
+NOTIFY_BACKOFF_BASE_S = 15
+NOTIFY_BACKOFF_MAX_S = 30 * 60
+# A claimed batch becomes due again only if its worker died: twice the worst-case send time
+NOTIFY_CLAIM_TIMEOUT_S = 2 * NOTIFY_BATCH_SIZE * NOTIFY_SEND_TIMEOUT_S
+
+# ----------------------------
+# Schools (tenants)
+# ----------------------------
+# Every school has its own SQLite shard and settings. The default school keeps
+# using bus.db; others are listed in schools.json, e.g.
+#   {"dps": {"name": "DPS", "lat": 28.56, "lon": 77.25, "average_bus_speed_kmph": 25}}
+DEFAULT_SCHOOL = "default"
+
+def load_schools():
+    schools = {DEFAULT_SCHOOL: {
+        'slug': DEFAULT_SCHOOL,
+        'name': "School",
+        'location': SCHOOL_LOCATION,
+        'db': DB,
+        'average_bus_speed_kmph': AVERAGE_BUS_SPEED_KMPH,
+        'bus_near_distance_km': BUS_NEAR_DISTANCE_KM,
+        'arrival_time': SCHOOL_ARRIVAL_TIME,
+        'utc_offset_min': SCHOOL_UTC_OFFSET_MIN
+    }}
+    if os.path.exists(SCHOOLS_CONFIG):
+        with open(SCHOOLS_CONFIG) as f:
+            config = json.load(f)
+        for slug, cfg in config.items():
+            if not re.fullmatch(r"[a-z0-9_-]+", slug):
+                raise ValueError(f"Invalid school id in {SCHOOLS_CONFIG}: {slug!r}")
+            school = dict(schools.get(slug, {}))
+            school.update({
+                'slug': slug,
+                'name': cfg.get('name', school.get('name', slug)),
+                'location': {'lat': cfg['lat'], 'lon': cfg['lon']} if 'lat' in cfg else school.get('location', SCHOOL_LOCATION),
+                'db': os.path.join(SHARD_DIR, cfg['db']) if 'db' in cfg else school.get('db', os.path.join(SHARD_DIR, f"{slug}.db")),
+                'average_bus_speed_kmph': cfg.get('average_bus_speed_kmph', AVERAGE_BUS_SPEED_KMPH),
+                'bus_near_distance_km': cfg.get('bus_near_distance_km', BUS_NEAR_DISTANCE_KM),
+                'arrival_time': cfg.get('arrival_time', SCHOOL_ARRIVAL_TIME),
+                'utc_offset_min': cfg.get('utc_offset_min', SCHOOL_UTC_OFFSET_MIN)
+            })
+            schools[slug] = school
+    return schools
+
+SCHOOLS = {}  # filled in by create_app()
 
 # ----------------------------
 # HTML Templates (with Bootstrap 5)
@@ -106,9 +261,19 @@ BASE_TEMPLATE = """
 </html>
 """
 
-HOME_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endblock %}", """
+HOME_TEMPLATE = """{% extends "base.html" %}
+{% block content %}
 <div class="text-center">
     <h1 class="mb-4">🚌 School Bus Tracker™</h1>
+    {% if schools|length > 1 %}
+    <form method="get" class="d-flex justify-content-center mb-4">
+        <select name="school" class="form-select w-auto" onchange="this.form.submit()">
+            {% for school in schools %}
+            <option value="{{ school.slug }}" {% if school.slug == g.school %}selected{% endif %}>{{ school.name }}</option>
+            {% endfor %}
+        </select>
+    </form>
+    {% endif %}
     <a href="{{ url_for('login', role='parent') }}" class="btn btn-primary btn-custom mx-2 mb-2">Parent Login</a>
     <a href="{{ url_for('login', role='driver') }}" class="btn btn-success btn-custom mx-2 mb-2">Driver Login</a>
     <a href="{{ url_for('admin_login') }}" class="btn btn-danger btn-custom mx-2 mb-2">Admin Login</a>
@@ -117,9 +282,11 @@ HOME_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endblock %}", """
     <a href="{{ url_for('register', role='parent') }}" class="btn btn-link">Parent Register</a> | 
     <a href="{{ url_for('register', role='driver') }}" class="btn btn-link">Driver Register</a>
 </div>
-""")
+{% endblock %}
+"""
 
-LOGIN_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endblock %}", """
+LOGIN_TEMPLATE = """{% extends "base.html" %}
+{% block content %}
 <h2 class="text-center">{{ role.title() }} Login</h2>
 <form method="post" class="mt-4">
     <div class="mb-3">
@@ -135,9 +302,11 @@ LOGIN_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endblock %}", """
 <div class="text-center mt-3">
     <a href="{{ url_for('home') }}">Back to Home</a>
 </div>
-""")
+{% endblock %}
+"""
 
-REGISTER_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endblock %}", """
+REGISTER_TEMPLATE = """{% extends "base.html" %}
+{% block content %}
 <h2 class="text-center">Register as {{ role.title() }}</h2>
 <form method="post" enctype="multipart/form-data" class="mt-4">
     <div class="mb-3">
@@ -165,9 +334,11 @@ REGISTER_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endblock %}", "
 <div class="text-center mt-3">
     <p class="mb-0">Already have an account? <a href="{{ url_for('login', role=role) }}">Login</a></p>
 </div>
-""")
+{% endblock %}
+"""
 
-EDIT_PROFILE_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endblock %}", """
+EDIT_PROFILE_TEMPLATE = """{% extends "base.html" %}
+{% block content %}
 <h2 class="text-center">Edit Profile</h2>
 <form method="post" enctype="multipart/form-data" class="mt-4">
     <div class="text-center mb-4">
@@ -190,9 +361,11 @@ EDIT_PROFILE_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endblock %}
 <div class="text-center mt-3">
     <a href="{{ url_for(session.role + '_dashboard') }}">Back to Dashboard</a>
 </div>
-""")
+{% endblock %}
+"""
 
-PARENT_DASHBOARD_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endblock %}", """
+PARENT_DASHBOARD_TEMPLATE = """{% extends "base.html" %}
+{% block content %}
 <h2 class="text-center">Parent Dashboard</h2>
 <div class="text-center my-4">
     <img src="{{ photo_url }}" class="profile-img" alt="Profile Photo">
@@ -237,9 +410,11 @@ PARENT_DASHBOARD_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endbloc
         <a href="{{ url_for('submit_complaint') }}" class="btn btn-warning btn-custom">Submit Complaint</a>
     </div>
 </div>
-""")
+{% endblock %}
+"""
 
-DRIVER_DASHBOARD_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endblock %}", """
+DRIVER_DASHBOARD_TEMPLATE = """{% extends "base.html" %}
+{% block content %}
 <h2 class="text-center">Driver Dashboard</h2>
 <div class="text-center my-4">
     <img src="{{ photo_url }}" class="profile-img" alt="Profile Photo">
@@ -256,7 +431,8 @@ DRIVER_DASHBOARD_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endbloc
         <h5 class="card-title">Location Update</h5>
         <p class="text-muted">Current Location: <span id="lat">N/A</span>, <span id="lon">N/A</span></p>
         <div class="d-grid gap-2">
-            <button class="btn btn-primary btn-custom" id="updateLocationBtn">Update My Location</button>
+            <button class="btn btn-primary btn-custom" id="updateLocationBtn">Start Sharing My Location</button>
+            <small class="text-muted text-center" id="locationStatus">Location sharing is off.</small>
             <a href="{{ url_for('edit_profile') }}" class="btn btn-outline-secondary btn-custom">Edit Profile</a>
         </div>
     </div>
@@ -264,7 +440,10 @@ DRIVER_DASHBOARD_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endbloc
 <div class="card mt-4">
     <div class="card-body">
         <h5 class="card-title">Notify Parents</h5>
-        <p>Click to send a WhatsApp message to the parent for each student when you arrive at their stop.</p>
+        <p>Let every parent on your route know the bus has arrived, or message a single parent on WhatsApp.</p>
+        <div class="d-grid mb-3">
+            <button class="btn btn-success btn-custom" id="notifyAllBtn">Notify All Parents</button>
+        </div>
         <ul class="list-group">
         {% for child in children %}
             <li class="list-group-item d-flex justify-content-between align-items-center">
@@ -280,56 +459,92 @@ DRIVER_DASHBOARD_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endbloc
 
 <script>
     const updateBtn = document.getElementById('updateLocationBtn');
-    updateBtn.addEventListener('click', () => {
-        updateBtn.disabled = true;
-        updateBtn.innerText = 'Getting location...';
+    const statusText = document.getElementById('locationStatus');
+    var sharing = false;
+    var nextReportTimer = null;
+
+    function scheduleNextReport(seconds) {
+        clearTimeout(nextReportTimer);
+        if (sharing) {
+            statusText.innerText = 'Next update in ' + seconds + 's';
+            nextReportTimer = setTimeout(reportLocation, seconds * 1000);
+        }
+    }
 
-        if (navigator.geolocation) {
-            navigator.geolocation.getCurrentPosition(position => {
-                const lat = position.coords.latitude;
-                const lon = position.coords.longitude;
-                document.getElementById('lat').innerText = lat.toFixed(6);
-                document.getElementById('lon').innerText = lon.toFixed(6);
-
-                fetch('{{ url_for("update_location") }}', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({ lat: lat, lon: lon })
-                })
-                .then(response => response.json())
-                .then(data => {
-                    alert(data.message);
-                    updateBtn.disabled = false;
-                    updateBtn.innerText = 'Update My Location';
-                })
-                .catch(error => {
-                    alert('Error updating location: ' + error);
-                    updateBtn.disabled = false;
-                    updateBtn.innerText = 'Update My Location';
-                });
-            }, error => {
-                alert('Geolocation error: ' + error.message);
-                updateBtn.disabled = false;
-                updateBtn.innerText = 'Update My Location';
-            });
-        } else {
+    function reportLocation() {
+        if (!navigator.geolocation) {
             alert("Geolocation is not supported by this browser.");
-            updateBtn.disabled = false;
-            updateBtn.innerText = 'Update My Location';
+            stopSharing();
+            return;
+        }
+        navigator.geolocation.getCurrentPosition(position => {
+            const lat = position.coords.latitude;
+            const lon = position.coords.longitude;
+            document.getElementById('lat').innerText = lat.toFixed(6);
+            document.getElementById('lon').innerText = lon.toFixed(6);
+
+            fetch('{{ url_for("update_location") }}', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({ lat: lat, lon: lon, accuracy: position.coords.accuracy, timestamp: position.timestamp })
+            })
+            .then(response => response.json())
+            .then(data => {
+                // The server decides how soon it wants the next fix
+                scheduleNextReport(data.next_report_s || {{ default_report_s }});
+            })
+            .catch(error => {
+                statusText.innerText = 'Error updating location: ' + error;
+                scheduleNextReport({{ default_report_s }});
+            });
+        }, error => {
+            statusText.innerText = 'Geolocation error: ' + error.message;
+            scheduleNextReport({{ default_report_s }});
+        });
+    }
+
+    function stopSharing() {
+        sharing = false;
+        clearTimeout(nextReportTimer);
+        updateBtn.innerText = 'Start Sharing My Location';
+        statusText.innerText = 'Location sharing is off.';
+    }
+
+    const notifyAllBtn = document.getElementById('notifyAllBtn');
+    notifyAllBtn.addEventListener('click', () => {
+        notifyAllBtn.disabled = true;
+        fetch('{{ url_for("notify_arrival") }}', {method: 'POST'})
+            .then(response => response.json())
+            .then(data => alert(data.message))
+            .catch(error => alert('Error notifying parents: ' + error))
+            .finally(() => { notifyAllBtn.disabled = false; });
+    });
+
+    updateBtn.addEventListener('click', () => {
+        if (sharing) {
+            stopSharing();
+            return;
         }
+        sharing = true;
+        updateBtn.innerText = 'Stop Sharing My Location';
+        statusText.innerText = 'Getting location...';
+        reportLocation();
     });
 </script>
-""")
+{% endblock %}
+"""
 
-BUS_MAP_TEMPLATE = BASE_TEMPLATE.replace("{% block head %}{% endblock %}", """
+BUS_MAP_TEMPLATE = """{% extends "base.html" %}
+{% block head %}
 <link rel="stylesheet" href="https://unpkg.com/leaflet@1.7.1/dist/leaflet.css" />
 <script src="https://unpkg.com/leaflet@1.7.1/dist/leaflet.js"></script>
-""").replace("{% block content %}{% endblock %}", """
+{% endblock %}
+{% block content %}
 <h2 class="text-center">Live Bus Map</h2>
 <div id="mapid" class="card"></div>
 <div class="d-grid gap-2 mt-3">
     {% for driver in drivers %}
-        <button class="btn btn-outline-primary" onclick="centerMap({{ driver.lat }}, {{ driver.lon }})">Follow {{ driver.name }}'s Bus</button>
+        <button class="btn btn-outline-primary" onclick="centerMap({{ driver.lat }}, {{ driver.lon }}, {{ driver.id }})">Follow {{ driver.name }}'s Bus</button>
     {% endfor %}
 </div>
 <p class="text-center mt-3"><a href="{{ url_for('parent_dashboard') }}">Back to Dashboard</a></p>
@@ -345,8 +560,34 @@ BUS_MAP_TEMPLATE = BASE_TEMPLATE.replace("{% block head %}{% endblock %}", """
     var schoolMarker = L.marker([{{ school_lat }}, {{ school_lon }}], {icon: L.divIcon({className: 'school-icon', html: '<div style="background-color:red;width:20px;height:20px;border-radius:50%;"></div>'})}).addTo(map);
     schoolMarker.bindPopup("<b>School</b>").openPopup();
 
-    function centerMap(lat, lon) {
+    var routeLine = null;
+
+    function decodePolyline(str) {
+        var points = [], index = 0, lat = 0, lon = 0;
+        while (index < str.length) {
+            [0, 1].forEach(i => {
+                var b, shift = 0, result = 0;
+                do {
+                    b = str.charCodeAt(index++) - 63;
+                    result |= (b & 0x1f) << shift;
+                    shift += 5;
+                } while (b >= 0x20);
+                var delta = (result & 1) ? ~(result >> 1) : (result >> 1);
+                if (i === 0) { lat += delta; } else { lon += delta; }
+            });
+            points.push([lat / 1e5, lon / 1e5]);
+        }
+        return points;
+    }
+
+    function centerMap(lat, lon, driverId) {
         map.setView([lat, lon], 13);
+        fetch('{{ url_for("track", driver_id=0) }}'.replace(/0$/, driverId) + '?zoom=' + map.getZoom())
+            .then(response => response.json())
+            .then(data => {
+                if (routeLine) { map.removeLayer(routeLine); }
+                routeLine = L.polyline(decodePolyline(data.polyline), {color: '#007bff'}).addTo(map);
+            });
     }
     
     function haversine_distance(coords1, coords2) {
@@ -365,6 +606,32 @@ BUS_MAP_TEMPLATE = BASE_TEMPLATE.replace("{% block head %}{% endblock %}", """
         return R * c;
     }
 
+    // Columnar feed: name, phone and photo are only sent when they change
+    var fleetStatic = null;
+
+    function fetchFleet() {
+        var url = '{{ url_for("bus_locations", format="columnar") }}' + (fleetStatic ? '&static=' + fleetStatic.version : '');
+        return fetch(url)
+            .then(response => response.json())
+            .then(data => {
+                if (data.static) {
+                    fleetStatic = { version: data.static_version, byId: {} };
+                    data.static.id.forEach((id, i) => {
+                        fleetStatic.byId[id] = { name: data.static.name[i], phone: data.static.phone[i], photo: data.photo_base + data.static.photo[i] };
+                    });
+                }
+                return data.id.map((id, i) => {
+                    var info = fleetStatic.byId[id] || {};
+                    return {
+                        id: id, name: info.name, phone: info.phone, photo: info.photo,
+                        lat: data.lat[i], lon: data.lon[i], rating: data.rating[i],
+                        eta: data.eta_minutes[i] > 0 ? data.eta_minutes[i] + ' mins' : 'Arrived!',
+                        last_updated: data.last_updated[i] ? new Date(data.last_updated[i] * 1000).toLocaleString() : 'N/A'
+                    };
+                });
+            });
+    }
+
     var lastAlertTime = 0;
     var alertedDrivers = {};
 
@@ -372,10 +639,9 @@ BUS_MAP_TEMPLATE = BASE_TEMPLATE.replace("{% block head %}{% endblock %}", """
         if (navigator.geolocation) {
             navigator.geolocation.getCurrentPosition(position => {
                 var parentCoords = { lat: position.coords.latitude, lon: position.coords.longitude };
-                fetch('{{ url_for("bus_locations") }}')
-                    .then(response => response.json())
-                    .then(data => {
-                        data.drivers.forEach(driver => {
+                fetchFleet()
+                    .then(drivers => {
+                        drivers.forEach(driver => {
                             var lat = driver.lat;
                             var lon = driver.lon;
 
@@ -422,9 +688,11 @@ BUS_MAP_TEMPLATE = BASE_TEMPLATE.replace("{% block head %}{% endblock %}", """
     updateBusLocationsAndCheckAlerts();
     setInterval(updateBusLocationsAndCheckAlerts, 5000);
 </script>
-""")
+{% endblock %}
+"""
 
-ADD_CHILD_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endblock %}", """
+ADD_CHILD_TEMPLATE = """{% extends "base.html" %}
+{% block content %}
 <h2 class="text-center">Add a Child Profile</h2>
 <form method="post" class="mt-4">
     <div class="mb-3">
@@ -449,9 +717,11 @@ ADD_CHILD_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endblock %}",
 <div class="text-center mt-3">
     <a href="{{ url_for('parent_dashboard') }}">Back to Dashboard</a>
 </div>
-""")
+{% endblock %}
+"""
 
-COMPLAINTS_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endblock %}", """
+COMPLAINTS_TEMPLATE = """{% extends "base.html" %}
+{% block content %}
 <h2 class="text-center">Submit a Complaint</h2>
 <form method="post" class="mt-4">
     <div class="mb-3">
@@ -472,9 +742,58 @@ COMPLAINTS_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endblock %}",
 <div class="text-center mt-3">
     <a href="{{ url_for('parent_dashboard') }}">Back to Dashboard</a>
 </div>
-""")
+{% endblock %}
+"""
+
+FEEDBACK_TEMPLATE = """{% extends "base.html" %}
+{% block content %}
+<h2 class="text-center">Rate Your Driver</h2>
+<form method="post" class="mt-4">
+    <div class="mb-3">
+        <label for="driver" class="form-label">Select Driver</label>
+        <select class="form-select" id="driver" name="driver_id" required>
+            <option value="">Choose...</option>
+            {% for driver in drivers %}
+            <option value="{{ driver.id }}">{{ driver.name }}</option>
+            {% endfor %}
+        </select>
+    </div>
+    <div class="mb-3">
+        <label for="rating" class="form-label">Rating</label>
+        <select class="form-select" id="rating" name="rating" required>
+            <option value="">Choose...</option>
+            {% for r in range(5, 0, -1) %}
+            <option value="{{ r }}">{{ r }} star{{ "s" if r > 1 }}</option>
+            {% endfor %}
+        </select>
+    </div>
+    <div class="mb-3">
+        <label for="message" class="form-label">Comments (optional)</label>
+        <textarea class="form-control" id="message" name="message" rows="3" placeholder="Tell us about your experience..."></textarea>
+    </div>
+    <button type="submit" class="btn btn-success w-100 btn-custom">Submit Feedback</button>
+</form>
+<div class="mt-4">
+    <h3>Your Past Feedback</h3>
+    <ul class="list-group">
+        {% for f in past_feedback %}
+        <li class="list-group-item">
+            <p><strong>{{ f.driver_name }}</strong> &mdash; {{ f.rating }} / 5</p>
+            {% if f.message %}<p class="border p-2 rounded">{{ f.message }}</p>{% endif %}
+        </li>
+        {% else %}
+        <li class="list-group-item text-muted">You have not rated a driver yet.</li>
+        {% endfor %}
+    </ul>
+</div>
+<div class="text-center mt-3">
+    <a href="{{ url_for('parent_dashboard') }}">Back to Dashboard</a>
+</div>
+{% endblock %}
+"""
 
-ADMIN_DASHBOARD_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endblock %}", """
+ADMIN_DASHBOARD_TEMPLATE = """{% extends "base.html" %}
+{% block content %}
 <h2 class="text-center">Admin Dashboard</h2>
 <div class="mt-4">
     <h3 class="text-danger">Service Complaints</h3>
@@ -491,41 +810,133 @@ ADMIN_DASHBOARD_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endblock
         {% endfor %}
     </ul>
 </div>
-""")
+{% endblock %}
+"""
 
-ERROR_TEMPLATE = BASE_TEMPLATE.replace("{% block content %}{% endblock %}", """
+ERROR_TEMPLATE = """{% extends "base.html" %}
+{% block content %}
 <div class="text-center">
     <h2 class="text-danger">Error {{ code }}</h2>
     <p>{{ message }}</p>
     <a href="{{ url_for('home') }}" class="btn btn-primary btn-custom">Return to Home</a>
 </div>
-""")
+{% endblock %}
+"""
+
+# Templates are compiled once by Jinja on first use and cached from then on
+TEMPLATES = {
+    "base.html": BASE_TEMPLATE,
+    "home.html": HOME_TEMPLATE,
+    "login.html": LOGIN_TEMPLATE,
+    "register.html": REGISTER_TEMPLATE,
+    "edit_profile.html": EDIT_PROFILE_TEMPLATE,
+    "parent_dashboard.html": PARENT_DASHBOARD_TEMPLATE,
+    "driver_dashboard.html": DRIVER_DASHBOARD_TEMPLATE,
+    "bus_map.html": BUS_MAP_TEMPLATE,
+    "add_child.html": ADD_CHILD_TEMPLATE,
+    "complaints.html": COMPLAINTS_TEMPLATE,
+    "feedback.html": FEEDBACK_TEMPLATE,
+    "admin_dashboard.html": ADMIN_DASHBOARD_TEMPLATE,
+    "error.html": ERROR_TEMPLATE,
+}
+app.jinja_loader = DictLoader(TEMPLATES)
 
 # ----------------------------
 # Database helpers
 # ----------------------------
+_ready_shards = set()
+_ready_lock = threading.Lock()
+
+def connect_shard(school):
+    # Each shard's schema is checked the first time this process connects to it
+    if school not in _ready_shards:
+        with _ready_lock:
+            if school not in _ready_shards:
+                init_db(school)
+                _ready_shards.add(school)
+    db = sqlite3.connect(SCHOOLS[school]['db'], check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    return db
+
+class ShardPool:
+    """Keeps a few idle connections to one school's database."""
+    def __init__(self, school, size=SHARD_POOL_SIZE):
+        self.school = school
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return connect_shard(self.school)
+
+    def release(self, db):
+        if db.in_transaction:
+            db.rollback()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(db)
+                return
+        db.close()
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(school):
+    # Pools are created on first use, so idle schools hold no connections
+    with _pools_lock:
+        if school not in _pools:
+            _pools[school] = ShardPool(school)
+        return _pools[school]
+
+def current_school():
+    return SCHOOLS[g.school]
+
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(DB)
-        g.db.row_factory = sqlite3.Row
+        g.db_school = g.school
+        g.db = get_pool(g.db_school).acquire()
     return g.db
 
+@app.before_request
+def select_school():
+    if not _app_ready:
+        create_app()
+    # Logged-in users stay in the school they logged into; everyone else can
+    # pick one with ?school= or the X-School header.
+    if 'user_id' in session:
+        slug = session.get('school', DEFAULT_SCHOOL)
+    else:
+        slug = request.args.get('school') or request.headers.get('X-School') or session.get('school') or DEFAULT_SCHOOL
+    if slug not in SCHOOLS:
+        g.school = DEFAULT_SCHOOL
+        return render_template("error.html", code=404, message="Unknown school"), 404
+    if session.get('school') != slug:
+        session['school'] = slug
+    g.school = slug
+
 @app.teardown_appcontext
 def close_db(error):
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        get_pool(g.pop('db_school')).release(db)
 
-def init_db():
-    db = get_db()
+def init_db(school=DEFAULT_SCHOOL, reset=False):
+    """Create missing tables and demo rows; existing data is kept unless reset."""
+    db = sqlite3.connect(SCHOOLS[school]['db'], timeout=30, isolation_level=None)
     cur = db.cursor()
-    # Drop tables to ensure fresh start for schema changes
-    cur.execute("DROP TABLE IF EXISTS parents")
-    cur.execute("DROP TABLE IF EXISTS drivers")
-    cur.execute("DROP TABLE IF EXISTS children")
-    cur.execute("DROP TABLE IF EXISTS feedback")
-    cur.execute("DROP TABLE IF EXISTS complaints")
-    cur.execute("DROP TABLE IF EXISTS users")
+    # Lets the retention job return freed pages with PRAGMA incremental_vacuum.
+    # Only takes effect on a new database; run_retention converts older files.
+    cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    # Workers starting together on a fresh shard queue up here, so only the
+    # first one creates and seeds it.
+    cur.execute("BEGIN IMMEDIATE")
+    if reset:
+        for table in ("parents", "drivers", "children", "feedback", "complaints",
+                      "users", "locations", "notifications", "daily_rollups", "cache_versions"):
+            cur.execute(f"DROP TABLE IF EXISTS {table}")
 
     cur.execute("""CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -580,28 +991,116 @@ def init_db():
         FOREIGN KEY (parent_id) REFERENCES parents(id),
         FOREIGN KEY (driver_id) REFERENCES drivers(id)
     )""")
-    db.commit()
+    cur.execute("""CREATE TABLE IF NOT EXISTS locations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        driver_id INTEGER,
+        lat REAL,
+        lon REAL,
+        recorded_at TEXT,
+        FOREIGN KEY (driver_id) REFERENCES drivers(id)
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_locations_driver_time ON locations (driver_id, recorded_at)")
+    cur.execute("""CREATE TABLE IF NOT EXISTS notifications (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        driver_id INTEGER,
+        parent_id INTEGER,
+        phone TEXT,
+        message TEXT,
+        status TEXT,
+        attempts INTEGER DEFAULT 0,
+        next_attempt_at REAL,
+        claim TEXT,
+        last_error TEXT,
+        created_at TEXT,
+        sent_at TEXT,
+        FOREIGN KEY (parent_id) REFERENCES parents(id),
+        FOREIGN KEY (driver_id) REFERENCES drivers(id)
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_notifications_due ON notifications (status, next_attempt_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_notifications_pair ON notifications (driver_id, parent_id, created_at)")
+    cur.execute("""CREATE TABLE IF NOT EXISTS cache_versions (
+        role TEXT,
+        user_id INTEGER,
+        version INTEGER NOT NULL,
+        PRIMARY KEY (role, user_id)
+    )""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS daily_rollups (
+        driver_id INTEGER,
+        day TEXT,
+        fixes INTEGER,
+        trips INTEGER,
+        distance_km REAL,
+        arrivals INTEGER,
+        first_arrival TEXT,
+        late_minutes REAL,
+        stops INTEGER,
+        dwell_minutes REAL,
+        PRIMARY KEY (driver_id, day),
+        FOREIGN KEY (driver_id) REFERENCES drivers(id)
+    )""")
 
     # Add dummy data for a realistic demo
     if not cur.execute("SELECT id FROM users WHERE username = 'admin'").fetchone():
-        db.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
-                   ('admin', generate_password_hash('pass'), 'admin'))
+        cur.execute("INSERT OR IGNORE INTO users (username, password, role) VALUES (?, ?, ?)",
+                    ('admin', generate_password_hash('pass', method=PASSWORD_HASH_METHOD), 'admin'))
     if not cur.execute("SELECT id FROM parents WHERE username = 'parent1'").fetchone():
-        db.execute("INSERT INTO parents (name, username, password, phone, photo) VALUES (?, ?, ?, ?, ?)",
-                   ('Parent One', 'parent1', generate_password_hash('pass'), '919876543210', 'static/default_profile.png'))
+        cur.execute("INSERT OR IGNORE INTO parents (name, username, password, phone, photo) VALUES (?, ?, ?, ?, ?)",
+                    ('Parent One', 'parent1', generate_password_hash('pass', method=PASSWORD_HASH_METHOD), '919876543210', 'static/default_profile.png'))
     if not cur.execute("SELECT id FROM drivers WHERE username = 'driver1'").fetchone():
-        db.execute("INSERT INTO drivers (name, username, password, phone, photo, lat, lon) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                   ('Driver One', 'driver1', generate_password_hash('pass'), '919988776655', 'static/default_profile.png', 28.7041, 77.1025))
+        cur.execute("INSERT OR IGNORE INTO drivers (name, username, password, phone, photo, lat, lon) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    ('Driver One', 'driver1', generate_password_hash('pass', method=PASSWORD_HASH_METHOD), '919988776655', 'static/default_profile.png', 28.7041, 77.1025))
     if not cur.execute("SELECT id FROM children").fetchone():
-        db.execute("INSERT INTO children (name, class_name, parent_id, driver_id) VALUES (?, ?, ?, ?)",
-                   ('Child A', 'Class 5', 1, 1))
-        db.execute("INSERT INTO children (name, class_name, parent_id, driver_id) VALUES (?, ?, ?, ?)",
-                   ('Child B', 'Class 3', 1, 1))
-    db.commit()
+        cur.execute("INSERT OR IGNORE INTO children (name, class_name, parent_id, driver_id) VALUES (?, ?, ?, ?)",
+                    ('Child A', 'Class 5', 1, 1))
+        cur.execute("INSERT OR IGNORE INTO children (name, class_name, parent_id, driver_id) VALUES (?, ?, ?, ?)",
+                    ('Child B', 'Class 3', 1, 1))
+    cur.execute("COMMIT")
+    db.close()
+
+@app.cli.command("init-db")
+@click.option("--reset", is_flag=True, help="Drop and recreate every table.")
+def init_db_command(reset):
+    """Create (or with --reset, recreate) every school's database."""
+    create_app()
+    for school in SCHOOLS:
+        init_db(school, reset=reset)
+        _ready_shards.add(school)
+        print(f"{school}: {'reset' if reset else 'ready'}")
 
-# Initialize DB once at startup
-with app.app_context():
-    init_db()
+# ----------------------------
+# Application factory
+# ----------------------------
+_app_ready = False
+_app_ready_lock = threading.Lock()
+_inherited_pools = []
+
+def create_app(config=None):
+    """Finish configuring the app. Cheap and idempotent; databases, threads and
+    pools are all opened lazily on first use, so this is safe before a fork."""
+    global _app_ready
+    if config:
+        app.config.update(config)
+    with _app_ready_lock:
+        if not _app_ready:
+            for directory in (app.config['UPLOAD_FOLDER'], os.path.join(os.path.abspath(os.path.dirname(__file__)), "static"),
+                              SHARD_DIR):
+                os.makedirs(directory, exist_ok=True)
+            SCHOOLS.update(load_schools())
+            _app_ready = True
+    return app
+
+def _reset_after_fork():
+    global _pools, _hash_pool, _dispatcher_thread
+    # Connections and threads belong to the parent process. The parent's
+    # connections are kept referenced (not closed) so SQLite never touches
+    # the parent's file locks from the child.
+    _inherited_pools.extend(_pools.values())
+    _pools = {}
+    _hash_pool = None
+    _dispatcher_thread = None
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
 
 # ----------------------------
 # Authentication helpers
@@ -620,10 +1119,186 @@ def login_required(role=None):
         return wrapped
     return decorator
 
+class TTLCache:
+    """Small LRU cache whose entries also expire after a fixed time."""
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get_or_load(self, key, load, version=None):
+        """Entries stored under a different version count as misses."""
+        entry = self.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        value = load()
+        if value is not None:
+            self.set(key, (version, value))
+        return value
+
+profile_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL_S)
+dashboard_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL_S)
+
+def user_cache_version(role, user_id):
+    # Looked up at most once per request for each user
+    versions = g.setdefault('cache_versions', {})
+    key = (role, int(user_id))
+    if key not in versions:
+        row = get_db().execute("SELECT version FROM cache_versions WHERE role = ? AND user_id = ?", key).fetchone()
+        versions[key] = row['version'] if row else 0
+    return versions[key]
+
+def bump_cache_version(role, user_id):
+    db = get_db()
+    db.execute("""INSERT INTO cache_versions (role, user_id, version) VALUES (?, ?, 1)
+        ON CONFLICT (role, user_id) DO UPDATE SET version = version + 1""", (role, int(user_id)))
+    db.commit()
+    g.setdefault('cache_versions', {}).pop((role, int(user_id)), None)
+
 def get_user_data(role, user_id):
+    def load():
+        row = get_db().execute(f"SELECT * FROM {role} WHERE id = ?", (user_id,)).fetchone()
+        return dict(row) if row else None
+    return profile_cache.get_or_load((g.school, role, user_id), load, user_cache_version(role, user_id))
+
+def invalidate_profile(role, user_id):
+    profile_cache.delete((g.school, role, user_id))
+    bump_cache_version(role, user_id)
+
+def invalidate_dashboard(role, user_id):
+    dashboard_cache.delete((g.school, role, int(user_id)))
+    bump_cache_version(role, user_id)
+
+# ----------------------------
+# Password hashing and login throttling
+# ----------------------------
+class LoginThrottled(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+_hash_pool = None  # created on first login, after any fork
+_hash_pool_lock = threading.Lock()
+_hash_slots = threading.BoundedSemaphore(LOGIN_HASH_WORKERS + LOGIN_HASH_QUEUE)
+_login_attempts = {}
+_login_attempts_lock = threading.Lock()
+AUTH_STATS = {'verifications': 0, 'hashes': 0, 'rehashed': 0, 'rejected_overload': 0,
+              'rejected_rate_limit': 0, 'timeouts': 0, 'hash_seconds_total': 0.0, 'hash_seconds_max': 0.0}
+
+def _timed_hash(fn, *args):
+    start = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        elapsed = time.perf_counter() - start
+        with _login_attempts_lock:
+            AUTH_STATS['hash_seconds_total'] += elapsed
+            AUTH_STATS['hash_seconds_max'] = max(AUTH_STATS['hash_seconds_max'], elapsed)
+
+def get_hash_pool():
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            _hash_pool = ThreadPoolExecutor(max_workers=LOGIN_HASH_WORKERS, thread_name_prefix="password-hash")
+        return _hash_pool
+
+def run_hash_job(counter, fn, *args):
+    if not _hash_slots.acquire(blocking=False):
+        with _login_attempts_lock:
+            AUTH_STATS['rejected_overload'] += 1
+        raise LoginThrottled("overloaded", LOGIN_HASH_TIMEOUT_S)
+    with _login_attempts_lock:
+        AUTH_STATS[counter] += 1
+    try:
+        future = get_hash_pool().submit(_timed_hash, fn, *args)
+    except BaseException:
+        _hash_slots.release()
+        raise
+    # The slot is held until the hash actually finishes, not until this request
+    # gives up waiting, so timed-out jobs still count against the queue limit.
+    future.add_done_callback(lambda _: _hash_slots.release())
+    try:
+        return future.result(timeout=LOGIN_HASH_TIMEOUT_S)
+    except FutureTimeoutError:
+        with _login_attempts_lock:
+            AUTH_STATS['timeouts'] += 1
+        raise LoginThrottled("timeout", LOGIN_HASH_TIMEOUT_S)
+
+def hash_password(password):
+    return run_hash_job('hashes', generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+def check_login_rate(table, username):
+    now = time.time()
+    keys = [('ip', request.remote_addr), ('user', g.school, table, username.lower())]
+    limits = [LOGIN_RATE_LIMIT_IP, LOGIN_RATE_LIMIT_USERNAME]
+    with _login_attempts_lock:
+        if len(_login_attempts) > 10000:
+            for key in [k for k, (start, _) in _login_attempts.items() if now - start >= LOGIN_RATE_WINDOW_S]:
+                del _login_attempts[key]
+        for key, limit in zip(keys, limits):
+            start, count = _login_attempts.get(key, (now, 0))
+            if now - start >= LOGIN_RATE_WINDOW_S:
+                start, count = now, 0
+            if count >= limit:
+                AUTH_STATS['rejected_rate_limit'] += 1
+                raise LoginThrottled("rate_limited", int(start + LOGIN_RATE_WINDOW_S - now) + 1)
+            _login_attempts[key] = (start, count + 1)
+
+_current_hash_prefix = None
+
+def needs_rehash(stored):
+    # Werkzeug hashes look like "scrypt:32768:8:1$salt$hash"; the prefix holds the parameters
+    global _current_hash_prefix
+    if _current_hash_prefix is None:
+        # Hashed once per process, on the pool like any other KDF run
+        _current_hash_prefix = run_hash_job('hashes', generate_password_hash, "", PASSWORD_HASH_METHOD).split("$", 1)[0]
+    return stored.split("$", 1)[0] != _current_hash_prefix
+
+def authenticate(table, username, password, where=""):
+    """Return the matching row id, or None. Raises LoginThrottled when over capacity."""
+    check_login_rate(table, username)
     db = get_db()
-    cur = db.execute(f"SELECT * FROM {role} WHERE id = ?", (user_id,))
-    return cur.fetchone()
+    row = db.execute(f"SELECT id, password FROM {table} WHERE username = ?{where}", (username,)).fetchone()
+    if not row or not run_hash_job('verifications', check_password_hash, row['password'], password):
+        return None
+    try:
+        if needs_rehash(row['password']):
+            db.execute(f"UPDATE {table} SET password = ? WHERE id = ?", (hash_password(password), row['id']))
+            db.commit()
+            with _login_attempts_lock:
+                AUTH_STATS['rehashed'] += 1
+    except LoginThrottled:
+        pass  # try again on a later login
+    return row['id']
+
+def throttled_login_response(role, error):
+    flash("Too many login attempts right now. Please try again shortly.", "warning")
+    response = app.make_response((render_template("login.html", role=role), 429))
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -638,17 +1313,868 @@ def calculate_distance(lat1, lon1, lat2, lon2):
     distance = R * c
     return distance
 
+# ----------------------------
+# Track history helpers
+# ----------------------------
+_track_cache = OrderedDict()
+_track_cache_lock = threading.Lock()
+
+def meters_per_pixel(zoom, lat):
+    # Web Mercator ground resolution for 256px tiles
+    return 156543.03392 * cos(radians(lat)) / (2 ** zoom)
+
+def simplify_track(points, tolerance_m):
+    """Douglas-Peucker over (lat, lon) points with a tolerance in meters."""
+    if len(points) < 3 or tolerance_m <= 0:
+        return list(points)
+    # Project onto a local equirectangular plane so distances are in meters
+    lat0 = radians(points[0][0])
+    xy = [(radians(lon) * cos(lat0) * 6371000, radians(lat) * 6371000) for lat, lon in points]
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        (x1, y1), (x2, y2) = xy[start], xy[end]
+        dx, dy = x2 - x1, y2 - y1
+        seg_len = sqrt(dx * dx + dy * dy)
+        max_dist, index = 0.0, None
+        for i in range(start + 1, end):
+            px, py = xy[i]
+            if seg_len == 0:
+                dist = sqrt((px - x1) ** 2 + (py - y1) ** 2)
+            else:
+                dist = abs(dy * px - dx * py + x2 * y1 - y2 * x1) / seg_len
+            if dist > max_dist:
+                max_dist, index = dist, i
+        if index is not None and max_dist > tolerance_m:
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+    return [p for p, k in zip(points, keep) if k]
+
+def encode_polyline(points, precision=5):
+    """Encode (lat, lon) points in the Google encoded-polyline format."""
+    factor = 10 ** precision
+    result = []
+    prev_lat = prev_lon = 0
+    for lat, lon in points:
+        lat_i, lon_i = int(round(lat * factor)), int(round(lon * factor))
+        for delta in (lat_i - prev_lat, lon_i - prev_lon):
+            value = ~(delta << 1) if delta < 0 else (delta << 1)
+            while value >= 0x20:
+                result.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            result.append(chr(value + 63))
+        prev_lat, prev_lon = lat_i, lon_i
+    return "".join(result)
+
+def get_simplified_track(driver_id, day, zoom):
+    """day is a school-local YYYY-MM-DD; recorded_at is stored in UTC."""
+    db = get_db()
+    # Plain range bounds on recorded_at so idx_locations_driver_time is used
+    start = datetime.strptime(day, "%Y-%m-%d") - timedelta(minutes=current_school()['utc_offset_min'])
+    bounds = (start.strftime("%Y-%m-%d %H:%M:%S"), (start + timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S"))
+    latest = db.execute("SELECT MAX(id) AS last_id, COUNT(*) AS total FROM locations WHERE driver_id = ? AND recorded_at >= ? AND recorded_at < ?",
+                        (driver_id, *bounds)).fetchone()
+    key = (g.school, driver_id, day, zoom)
+    # The newest fix id is part of the cached entry so today's trip refreshes as fixes arrive
+    version = (latest['last_id'], latest['total'])
+    with _track_cache_lock:
+        cached = _track_cache.get(key)
+        if cached and cached[0] == version:
+            _track_cache.move_to_end(key)
+            return cached[1]
+
+    rows = db.execute("SELECT lat, lon FROM locations WHERE driver_id = ? AND recorded_at >= ? AND recorded_at < ? ORDER BY recorded_at, id",
+                      (driver_id, *bounds)).fetchall()
+    points = [(r['lat'], r['lon']) for r in rows]
+    tolerance = TRACK_TOLERANCE_PX * meters_per_pixel(zoom, points[0][0]) if points else 0
+    simplified = simplify_track(points, tolerance)
+    track = {
+        'driver_id': driver_id,
+        'date': day,
+        'zoom': zoom,
+        'points': len(points),
+        'simplified_points': len(simplified),
+        'polyline': encode_polyline(simplified)
+    }
+    with _track_cache_lock:
+        _track_cache[key] = (version, track)
+        _track_cache.move_to_end(key)
+        while len(_track_cache) > TRACK_CACHE_SIZE:
+            _track_cache.popitem(last=False)
+    return track
+
+# ----------------------------
+# GPS ingest filter
+# ----------------------------
+# Last accepted fix per driver. Counters are per worker process.
+_ingest_state = {}
+_ingest_lock = threading.Lock()
+INGEST_STATS = {'received': 0, 'accepted': 0, 'dropped_duplicate': 0, 'dropped_stationary': 0, 'dropped_out_of_order': 0, 'rejected_speed': 0,
+                'clock_skew_ignored': 0}
+
+def filter_fix(driver_key, lat, lon, timestamp=None, accuracy=None):
+    """Decide whether a fix is worth storing.
+
+    driver_key identifies the bus across schools, e.g. (school, driver_id).
+
+    Returns (verdict, lat, lon) where verdict is 'accepted' or the
+    INGEST_STATS counter that explains why the fix was dropped, and lat/lon are the (optionally smoothed) coordinates to store.
+    """
+    now = time.time()
+    with _ingest_lock:
+        INGEST_STATS['received'] += 1
+        if timestamp is not None:
+            # A phone with a wrong clock must not stamp a fix in the future, or every
+            # later fix would look out of order until that time passed.
+            if abs(timestamp - now) <= INGEST_MAX_CLOCK_SKEW_S:
+                now = timestamp
+            else:
+                INGEST_STATS['clock_skew_ignored'] += 1
+        last = _ingest_state.get(driver_key)
+        if last is None:
+            verdict = 'accepted'
+        else:
+            dt = now - last['t']
+            moved_m = calculate_distance(last['raw_lat'], last['raw_lon'], lat, lon) * 1000
+            if dt < 0:
+                # The newer fix has already been stored
+                verdict = 'dropped_out_of_order'
+            elif (lat, lon) == (last['raw_lat'], last['raw_lon']) and dt < INGEST_HEARTBEAT_S:
+                verdict = 'dropped_duplicate'
+            elif dt > 0 and moved_m / dt * 3.6 > INGEST_MAX_SPEED_KMPH:
+                verdict = 'rejected_speed'
+            elif moved_m < INGEST_MIN_MOVE_M and dt < INGEST_HEARTBEAT_S:
+                verdict = 'dropped_stationary'
+            else:
+                verdict = 'accepted'
+        INGEST_STATS[verdict] += 1
+        if verdict in ('dropped_duplicate', 'dropped_stationary') and dt > 0:
+            # Not stored, but still tells us the bus is (nearly) standing still
+            last['speed_kmph'] = moved_m / dt * 3.6
+        if verdict != 'accepted':
+            return verdict, lat, lon
+
+        out_lat, out_lon = lat, lon
+        variance = (accuracy or INGEST_DEFAULT_ACCURACY_M) ** 2
+        speed_kmph = 0.0
+        if last is not None:
+            dt = max(now - last['t'], 0)
+            speed_kmph = calculate_distance(last['lat'], last['lon'], lat, lon) / dt * 3600 if dt else last['speed_kmph']
+            if INGEST_SMOOTHING:
+                # Constant-position Kalman filter applied independently to each axis
+                prior = last['variance'] + INGEST_KALMAN_Q * dt
+                gain = prior / (prior + variance)
+                out_lat = last['lat'] + gain * (lat - last['lat'])
+                out_lon = last['lon'] + gain * (lon - last['lon'])
+                variance = (1 - gain) * prior
+        _ingest_state[driver_key] = {
+            'lat': out_lat, 'lon': out_lon,
+            'raw_lat': lat, 'raw_lon': lon,
+            't': now, 'variance': variance, 'speed_kmph': speed_kmph
+        }
+        return verdict, out_lat, out_lon
+
+def next_report_interval(driver_key, lat, lon, school, now=None):
+    """now is a UTC datetime; service hours are in the school's local time."""
+    local = (now or datetime.now(timezone.utc)) + timedelta(minutes=school['utc_offset_min'])
+    if not SERVICE_HOURS[0] <= local.hour < SERVICE_HOURS[1]:
+        return REPORT_INTERVAL_OFF_SHIFT_S
+    with _ingest_lock:
+        state = _ingest_state.get(driver_key)
+        speed_kmph = state['speed_kmph'] if state else 0.0
+        if state:
+            # Judge distance from the last accepted fix, never from one just rejected as a GPS jump
+            lat, lon = state['lat'], state['lon']
+    # A bus standing still reports slowly even at the school; only a moving bus near it reports fast
+    if speed_kmph < REPORT_PARKED_KMPH:
+        return REPORT_INTERVAL_IDLE_S
+    if calculate_distance(lat, lon, school['location']['lat'], school['location']['lon']) <= REPORT_NEAR_SCHOOL_KM:
+        return REPORT_INTERVAL_MIN_S
+    seconds = REPORT_DISTANCE_M / (speed_kmph / 3.6)
+    return int(min(max(seconds, REPORT_INTERVAL_MIN_S), REPORT_INTERVAL_MOVING_S))
+
+# ----------------------------
+# Notification outbox
+# ----------------------------
+class StubTransport:
+    """Keeps messages in memory and logs them. Used for local testing."""
+    def __init__(self):
+        self.sent = deque(maxlen=NOTIFY_STUB_KEEP)
+
+    def send(self, phone, message):
+        logging.info("Notification to %s: %s", phone, message)
+        self.sent.append((phone, message))
+
+class WebhookTransport:
+    """POSTs each message as JSON to a delivery gateway."""
+    def __init__(self, url, timeout=NOTIFY_SEND_TIMEOUT_S):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, phone, message):
+        import urllib.request
+        body = json.dumps({'phone': phone, 'message': message}).encode("utf-8")
+        req = urllib.request.Request(self.url, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            if resp.status >= 300:
+                raise RuntimeError(f"Gateway returned HTTP {resp.status}")
+
+def make_transport():
+    if NOTIFY_TRANSPORT == "webhook":
+        if not NOTIFY_WEBHOOK_URL:
+            raise RuntimeError("NOTIFY_WEBHOOK_URL must be set for the webhook transport")
+        return WebhookTransport(NOTIFY_WEBHOOK_URL)
+    if NOTIFY_TRANSPORT == "stub" or app.debug or app.testing:
+        return StubTransport()
+    if NOTIFY_TRANSPORT:
+        raise RuntimeError(f"Unknown NOTIFY_TRANSPORT {NOTIFY_TRANSPORT!r}")
+    logging.warning("NOTIFY_TRANSPORT is not set; parent notifications are disabled")
+    return None
+
+notification_transport = None
+_transport_ready = False
+
+def get_transport():
+    # Chosen on first use, after app.run(debug=...) or the test config has been applied
+    global notification_transport, _transport_ready
+    if not _transport_ready:
+        try:
+            notification_transport = make_transport()
+        except RuntimeError:
+            # A bad setting disables notifications; it must not fail every request
+            logging.exception("Invalid notification settings; parent notifications are disabled")
+        _transport_ready = True
+    return notification_transport
+_dispatcher_wakeup = threading.Event()
+_dispatcher_thread = None
+_dispatcher_lock = threading.Lock()
+
+def enqueue_arrival_notifications(driver_id):
+    """Queue one arrival message per parent on this bus. Returns how many were new."""
+    db = get_db()
+    rows = db.execute("""
+        SELECT p.id AS parent_id, p.name AS parent_name, p.phone AS parent_phone, c.name AS child_name
+        FROM children c JOIN parents p ON c.parent_id = p.id
+        WHERE c.driver_id = ? ORDER BY p.id, c.name
+    """, (driver_id,)).fetchall()
+
+    by_parent = OrderedDict()
+    for r in rows:
+        by_parent.setdefault(r['parent_id'], (r['parent_name'], r['parent_phone'], []))[2].append(r['child_name'])
+
+    now = time.time()
+    before = db.total_changes
+    # Skipped when this parent already got a message for this bus within the window;
+    # the check and insert are one statement, so concurrent clicks cannot both pass.
+    db.executemany("""INSERT INTO notifications
+        (driver_id, parent_id, phone, message, status, attempts, next_attempt_at, created_at)
+        SELECT ?, ?, ?, ?, 'pending', 0, ?, datetime('now')
+        WHERE NOT EXISTS (SELECT 1 FROM notifications WHERE driver_id = ? AND parent_id = ?
+                          AND created_at > datetime('now', ?))""", [
+        (driver_id, parent_id, phone,
+         f"Hi {name}, the bus has arrived at {' and '.join(kids)}'s stop. Have a great day!",
+         now,
+         driver_id, parent_id, f"-{NOTIFY_DEDUPE_WINDOW_S} seconds")
+        for parent_id, (name, phone, kids) in by_parent.items()
+    ])
+    db.commit()
+    queued = db.total_changes - before
+    if queued:
+        start_dispatcher()
+        _dispatcher_wakeup.set()
+    return queued
+
+def dispatch_pending(db, transport, limit=NOTIFY_BATCH_SIZE):
+    """Claim and deliver one batch of due notifications. Returns the batch size."""
+    now = time.time()
+    claim = uuid.uuid4().hex
+    # Claiming pushes next_attempt_at forward, so a batch left behind by a dead worker is retried later
+    db.execute("""UPDATE notifications SET status = 'sending', claim = ?, next_attempt_at = ?
+        WHERE id IN (SELECT id FROM notifications WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+                     ORDER BY driver_id, id LIMIT ?)""", (claim, now + NOTIFY_CLAIM_TIMEOUT_S, now, limit))
+    db.commit()
+    batch = db.execute("SELECT id, phone, message, attempts FROM notifications WHERE claim = ? AND status = 'sending'",
+                       (claim,)).fetchall()
+    # Results only apply while the row is still under this claim
+    for n in batch:
+        try:
+            transport.send(n['phone'], n['message'])
+        except Exception as e:
+            attempts = n['attempts'] + 1
+            if attempts >= NOTIFY_MAX_ATTEMPTS:
+                db.execute("UPDATE notifications SET status = 'failed', attempts = ?, last_error = ? WHERE id = ? AND claim = ?",
+                           (attempts, str(e), n['id'], claim))
+            else:
+                delay = min(NOTIFY_BACKOFF_BASE_S * 2 ** (attempts - 1), NOTIFY_BACKOFF_MAX_S)
+                db.execute("UPDATE notifications SET status = 'pending', attempts = ?, last_error = ?, next_attempt_at = ? WHERE id = ? AND claim = ?",
+                           (attempts, str(e), time.time() + delay, n['id'], claim))
+        else:
+            db.execute("UPDATE notifications SET status = 'sent', attempts = attempts + 1, sent_at = datetime('now') WHERE id = ? AND claim = ?",
+                       (n['id'], claim))
+        db.commit()
+    return len(batch)
+
+def _dispatcher_loop():
+    while True:
+        _dispatcher_wakeup.clear()
+        # Only schools this process already serves; idle shards stay closed and are
+        # picked up (with any leftover rows) once a request opens their pool.
+        with _pools_lock:
+            active = list(_pools)
+        for school in active:
+            pool = get_pool(school)
+            db = pool.acquire()
+            try:
+                while dispatch_pending(db, get_transport()):
+                    pass
+            except Exception:
+                logging.exception("Notification dispatch failed for school %s", school)
+            finally:
+                pool.release(db)
+        _dispatcher_wakeup.wait(NOTIFY_POLL_S)
+
+def start_dispatcher():
+    global _dispatcher_thread
+    with _dispatcher_lock:
+        if _dispatcher_thread is None or not _dispatcher_thread.is_alive():
+            _dispatcher_thread = threading.Thread(target=_dispatcher_loop, name="notification-dispatcher", daemon=True)
+            _dispatcher_thread.start()
+
+@app.before_request
+def ensure_dispatcher():
+    # Each worker starts delivering on its first request, so rows left pending or
+    # claimed by a previous process are retried after a deploy or restart.
+    if _dispatcher_thread is None and get_transport():
+        start_dispatcher()
+
+# ----------------------------
+# Fleet snapshot cache
+# ----------------------------
+class SnapshotCache:
+    """Time-bucketed cache where concurrent misses share a single rebuild."""
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._building = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        while True:
+            bucket = int(time.time() // self.ttl)
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and entry[0] == bucket:
+                    return entry[1]
+                pending = self._building.get(key)
+                leader = pending is None
+                if leader:
+                    pending = self._building[key] = threading.Event()
+            if not leader:
+                # Somebody else is rebuilding; wait for their result, or take over if they failed
+                pending.wait(self.ttl * 5)
+                continue
+            try:
+                value = build()
+                with self._lock:
+                    # Expired entries go on every write, so keys that stop being
+                    # requested do not pin their snapshots for the life of the process
+                    for stale in [k for k, (b, _) in self._entries.items() if b != bucket]:
+                        del self._entries[stale]
+                    self._entries[key] = (bucket, value)
+                return value
+            finally:
+                with self._lock:
+                    del self._building[key]
+                pending.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+fleet_cache = SnapshotCache(FLEET_CACHE_TTL_S)
+
+def public_base_url():
+    return PUBLIC_BASE_URL or request.host_url.rstrip('/')
+
+def build_fleet_snapshot():
+    db = get_db()
+    school = current_school()
+    drivers = db.execute("""
+        SELECT d.id, d.name, d.phone, d.photo, d.lat, d.lon, d.last_updated, r.avg_rating
+        FROM drivers d
+        LEFT JOIN (SELECT driver_id, AVG(rating) AS avg_rating FROM feedback GROUP BY driver_id) r ON r.driver_id = d.id
+        WHERE d.lat IS NOT NULL AND d.lon IS NOT NULL
+    """).fetchall()
+
+    locations = []
+    fleet = []
+    for driver in drivers:
+        photo_url = url_for("uploaded_file", filename=os.path.basename(driver['photo'])) if "uploads/" in driver['photo'] else url_for('static', filename=os.path.basename(driver['photo']))
+
+        distance = calculate_distance(driver['lat'], driver['lon'], school['location']['lat'], school['location']['lon'])
+        eta_minutes = int((distance / school['average_bus_speed_kmph']) * 60)
+
+        eta_string = f"{eta_minutes} mins" if eta_minutes > 0 else "Arrived!"
+
+        locations.append({
+            'id': driver['id'],
+            'name': driver['name'],
+            'phone': driver['phone'],
+            'photo': public_base_url() + photo_url,
+            'lat': driver['lat'],
+            'lon': driver['lon'],
+            'rating': driver['avg_rating'],
+            'eta': eta_string,
+            'last_updated': driver['last_updated']
+        })
+        fleet.append({
+            'id': driver['id'],
+            'name': driver['name'],
+            'phone': driver['phone'],
+            'photo': photo_url,
+            'lat': driver['lat'],
+            'lon': driver['lon'],
+            'rating': driver['avg_rating'],
+            'eta_minutes': max(eta_minutes, 0),
+            'last_updated': sqlite_time_to_epoch(driver['last_updated'])
+        })
+    # Serialize and compress once; every request in this interval copies these bytes
+    body = app.json.dumps({'drivers': locations}).encode("utf-8") + b"\n"
+    return {
+        'fleet': fleet,
+        'photo_base': public_base_url(),
+        'static_version': fleet_static_version(fleet),
+        'json': body,
+        'json_gzip': gzip.compress(body, mtime=0),
+        'etag': hashlib.sha1(body).hexdigest()
+    }
+
+def sqlite_time_to_epoch(value):
+    if not value:
+        return None
+    return int(datetime.strptime(value, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp())
+
+# ----------------------------
+# Compact fleet encodings
+# ----------------------------
+# Name, phone and photo rarely change, so compact clients receive them only
+# when their cached copy (identified by static_version) is out of date.
+FLEET_STATIC_FIELDS = ('id', 'name', 'phone', 'photo')
+# Binary record: id, lat/lon in microdegrees, rating x50 (0 = none),
+# ETA minutes, last update as epoch seconds (0 = never)
+FLEET_BINARY_RECORD = struct.Struct("<IiiBHI")
+FLEET_BINARY_HEADER = struct.Struct("<4sBBI8s")  # magic, version, flags, count, static version
+FLEET_BINARY_MAGIC = b"BUSF"
+
+def fleet_static_version(fleet):
+    digest = hashlib.sha1()
+    for bus in fleet:
+        digest.update(json.dumps([bus[f] for f in FLEET_STATIC_FIELDS]).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+def encode_fleet_columnar(fleet, photo_base, static_version, include_static=True):
+    payload = {
+        'static_version': static_version,
+        'id': [bus['id'] for bus in fleet],
+        'lat': [bus['lat'] for bus in fleet],
+        'lon': [bus['lon'] for bus in fleet],
+        'rating': [None if bus['rating'] is None else round(bus['rating'], 2) for bus in fleet],
+        'eta_minutes': [bus['eta_minutes'] for bus in fleet],
+        'last_updated': [bus['last_updated'] for bus in fleet]
+    }
+    if include_static:
+        payload['photo_base'] = photo_base
+        payload['static'] = {f: [bus[f] for bus in fleet] for f in FLEET_STATIC_FIELDS}
+    return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+def encode_fleet_binary(fleet, static_version, include_static=True):
+    out = bytearray(FLEET_BINARY_HEADER.pack(FLEET_BINARY_MAGIC, 1, 1 if include_static else 0,
+                                             len(fleet), bytes.fromhex(static_version)))
+    for bus in fleet:
+        # Clamped to the field widths so one bad row cannot fail the whole feed
+        out += FLEET_BINARY_RECORD.pack(
+            bus['id'],
+            int(round(min(max(bus['lat'], -90.0), 90.0) * 1e6)),
+            int(round(min(max(bus['lon'], -180.0), 180.0) * 1e6)),
+            0 if bus['rating'] is None else min(max(int(round(bus['rating'] * 50)), 0), 0xFF),
+            min(max(bus['eta_minutes'], 0), 0xFFFF),
+            min(max(bus['last_updated'] or 0, 0), 0xFFFFFFFF)
+        )
+    if include_static:
+        # Length-prefixed UTF-8 name, phone and photo path, in record order
+        for bus in fleet:
+            for field in FLEET_STATIC_FIELDS[1:]:
+                value = (bus[field] or "").encode("utf-8")
+                out += struct.pack("<H", len(value)) + value
+    return bytes(out)
+
+def encoded_fleet(snapshot, mimetype, include_static, compressed):
+    """Return (body, etag) for one representation, encoding it once per snapshot."""
+    key = (mimetype, include_static, compressed)
+    variants = snapshot.setdefault('variants', {})
+    if key not in variants:
+        if compressed:
+            body = gzip.compress(encoded_fleet(snapshot, mimetype, include_static, False)[0], mtime=0)
+        elif mimetype == FLEET_BINARY_MIMETYPE:
+            body = encode_fleet_binary(snapshot['fleet'], snapshot['static_version'], include_static)
+        else:
+            body = encode_fleet_columnar(snapshot['fleet'], snapshot['photo_base'], snapshot['static_version'], include_static)
+        variants[key] = (body, hashlib.sha1(body).hexdigest())
+    return variants[key]
+
+# ----------------------------
+# Trip analytics
+# ----------------------------
+# Location fixes are streamed once, in (driver, time) order, through a chain of
+# generators. Only the current driver-day is held in memory.
+def iter_fixes(db, since_utc):
+    cur = db.execute("SELECT driver_id, lat, lon, recorded_at FROM locations WHERE recorded_at >= ? ORDER BY driver_id, recorded_at, id",
+                     (since_utc.strftime("%Y-%m-%d %H:%M:%S"),))
+    for row in cur:
+        yield row['driver_id'], datetime.strptime(row['recorded_at'], "%Y-%m-%d %H:%M:%S"), row['lat'], row['lon']
+
+def summarize_days(fixes, school):
+    """Yield one summary dict per driver and local day from time-ordered fixes."""
+    offset = timedelta(minutes=school['utc_offset_min'])
+    arrival_radius_km = school['bus_near_distance_km']
+    scheduled = datetime.strptime(school['arrival_time'], "%H:%M").time()
+    day = None
+    for driver_id, recorded_at, lat, lon in fixes:
+        local = recorded_at + offset
+        key = (driver_id, local.date())
+        if day is None or day['key'] != key:
+            if day is not None:
+                yield _finish_day(day, scheduled)
+            day = {'key': key, 'fixes': 0, 'trips': 0, 'distance_km': 0.0, 'arrivals': 0, 'first_arrival': None,
+                   'stops': 0, 'dwell_s': 0.0, 'prev': None, 'at_school': False, 'anchor': None}
+        day['fixes'] += 1
+        prev = day['prev']
+        new_trip = prev is None or (recorded_at - prev[0]).total_seconds() > TRIP_GAP_S
+        if new_trip:
+            day['trips'] += 1
+            _close_stop(day, prev)
+            day['anchor'] = (recorded_at, lat, lon)
+        else:
+            day['distance_km'] += calculate_distance(prev[1], prev[2], lat, lon)
+            anchor = day['anchor']
+            if calculate_distance(anchor[1], anchor[2], lat, lon) * 1000 > STOP_RADIUS_M:
+                _close_stop(day, prev)
+                day['anchor'] = (recorded_at, lat, lon)
+
+        at_school = calculate_distance(lat, lon, school['location']['lat'], school['location']['lon']) <= arrival_radius_km
+        # A trip that starts inside the radius (parked at school) has not arrived yet;
+        # only entering the radius after being outside it counts.
+        if at_school and not day['at_school'] and not new_trip:
+            day['arrivals'] += 1
+            if day['first_arrival'] is None:
+                day['first_arrival'] = local
+        day['at_school'] = at_school
+        day['prev'] = (recorded_at, lat, lon)
+    if day is not None:
+        yield _finish_day(day, scheduled)
+
+def _close_stop(day, prev):
+    anchor = day['anchor']
+    if anchor is None or prev is None:
+        return
+    dwell = (prev[0] - anchor[0]).total_seconds()
+    if dwell >= STOP_MIN_DWELL_S:
+        day['stops'] += 1
+        day['dwell_s'] += dwell
+
+def _finish_day(day, scheduled):
+    _close_stop(day, day['prev'])
+    driver_id, local_day = day['key']
+    first = day['first_arrival']
+    late = None
+    if first is not None:
+        late = round((first - datetime.combine(local_day, scheduled)).total_seconds() / 60, 1)
+    return {
+        'driver_id': driver_id,
+        'day': local_day.isoformat(),
+        'fixes': day['fixes'],
+        'trips': day['trips'],
+        'distance_km': round(day['distance_km'], 3),
+        'arrivals': day['arrivals'],
+        'first_arrival': first.strftime("%H:%M:%S") if first else None,
+        'late_minutes': late,
+        'stops': day['stops'],
+        'dwell_minutes': round(day['dwell_s'] / 60, 1)
+    }
+
+def run_rollups(school, since_day=None):
+    """Recompute daily rollups from since_day (default: the last rolled-up day). Returns rows written."""
+    db = connect_shard(school)
+    try:
+        if since_day is None:
+            last = db.execute("SELECT MAX(day) AS day FROM daily_rollups").fetchone()['day']
+            since_day = last or "1970-01-01"
+        # The first local day starts before midnight UTC when the offset is positive
+        since_utc = datetime.strptime(since_day, "%Y-%m-%d") - timedelta(minutes=SCHOOLS[school]['utc_offset_min'])
+        written = 0
+        batch = []
+        for summary in summarize_days(iter_fixes(db, since_utc), SCHOOLS[school]):
+            batch.append(summary)
+            if len(batch) >= 500:
+                written += _write_rollups(db, batch)
+                batch = []
+        written += _write_rollups(db, batch)
+        db.commit()
+        return written
+    finally:
+        db.close()
+
+def _write_rollups(db, batch):
+    db.executemany("""INSERT OR REPLACE INTO daily_rollups
+        (driver_id, day, fixes, trips, distance_km, arrivals, first_arrival, late_minutes, stops, dwell_minutes)
+        VALUES (:driver_id, :day, :fixes, :trips, :distance_km, :arrivals, :first_arrival, :late_minutes, :stops, :dwell_minutes)""", batch)
+    return len(batch)
+
+@app.cli.command("rollup")
+@click.option("--school", "schools", multiple=True, help="School id; defaults to every school.")
+@click.option("--since", default=None, help="First day (YYYY-MM-DD) to recompute.")
+def rollup_command(schools, since):
+    """Summarize stored location fixes into per-day punctuality rollups."""
+    create_app()
+    for school in schools or SCHOOLS:
+        print(f"{school}: {run_rollups(school, since)} driver-days written")
+
+# ----------------------------
+# Data retention and archive
+# ----------------------------
+def archive_path(school, table, month):
+    return os.path.join(ARCHIVE_DIR, school, f"{table}-{month}.jsonl.gz")
+
+def archive_table(db, school, table, cutoff):
+    """Move rows older than cutoff into monthly archive files. Returns rows moved."""
+    column = RETENTION_TIME_COLUMNS[table]
+    moved = 0
+    while True:
+        rows = db.execute(f"SELECT * FROM {table} WHERE {column} < ? ORDER BY id LIMIT ?",
+                          (cutoff, RETENTION_BATCH_SIZE)).fetchall()
+        if not rows:
+            return moved
+        by_month = OrderedDict()
+        for row in rows:
+            by_month.setdefault((row[column] or "0000-00")[:7], []).append(dict(row))
+        # Each batch is appended as a new gzip member, so existing data is never rewritten.
+        # Rows are deleted only after the archive is on disk; a crash in between
+        # can duplicate rows in the archive, which read_archive skips.
+        for month, items in by_month.items():
+            path = archive_path(school, table, month)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            lines = "".join(json.dumps(item, separators=(",", ":")) + "\n" for item in items)
+            with open(path, "ab") as f:
+                f.write(gzip.compress(lines.encode("utf-8")))
+                f.flush()
+                os.fsync(f.fileno())
+        db.executemany(f"DELETE FROM {table} WHERE id = ?", [(row['id'],) for row in rows])
+        db.commit()
+        moved += len(rows)
+
+def run_retention(school, now=None):
+    now = now or datetime.now(timezone.utc)
+    db = connect_shard(school)
+    try:
+        moved = {}
+        for table, days in RETENTION_DAYS.items():
+            cutoff = (now - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+            moved[table] = archive_table(db, school, table, cutoff)
+        if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # One-off conversion of databases created before incremental vacuum was enabled
+            db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            db.execute("VACUUM")
+        else:
+            # Run as a script: the sqlite3 module steps a PRAGMA that returns rows only
+            # once, which frees a single page instead of the whole freelist.
+            db.executescript("PRAGMA incremental_vacuum;")
+        return moved
+    finally:
+        db.close()
+
+def read_archive(school, table, start_day, end_day):
+    """Yield archived rows of table whose time falls within [start_day, end_day]."""
+    column = RETENTION_TIME_COLUMNS[table]
+    end = end_day + " 23:59:59"
+    month = start_day[:7]
+    while month <= end_day[:7]:
+        path = archive_path(school, table, month)
+        if os.path.exists(path):
+            seen = set()
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    row = json.loads(line)
+                    if start_day <= (row[column] or "") <= end and row['id'] not in seen:
+                        seen.add(row['id'])
+                        yield row
+        year, mon = int(month[:4]), int(month[5:])
+        month = f"{year + mon // 12:04d}-{mon % 12 + 1:02d}"
+
+@app.cli.command("archive")
+@click.option("--school", "schools", multiple=True, help="School id; defaults to every school.")
+def archive_command(schools):
+    """Archive rows past their retention period and vacuum the databases."""
+    create_app()
+    for school in schools or SCHOOLS:
+        moved = run_retention(school)
+        print(f"{school}: " + ", ".join(f"{table} {count}" for table, count in moved.items()))
+
+# ----------------------------
+# Response compression
+# ----------------------------
+_brotli = None
+
+def load_brotli():
+    """Import the optional brotli module on first use; returns None when it is not installed."""
+    global _brotli
+    if _brotli is None:
+        try:
+            import brotli
+        except ImportError:
+            brotli = False
+        _brotli = brotli
+    return _brotli or None
+
+_compress_cache = OrderedDict()
+_compress_cache_bytes = 0
+_compress_cache_lock = threading.Lock()
+
+def negotiate_encoding():
+    br = request.accept_encodings.quality('br') if load_brotli() else 0
+    gz = request.accept_encodings.quality('gzip')
+    if br > 0 and br >= gz:
+        return "br"
+    if gz > 0:
+        return "gzip"
+    return None
+
+def compress_bytes(data, encoding, best=False):
+    if encoding == "br":
+        return load_brotli().compress(data, quality=11 if best else COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=9 if best else COMPRESS_LEVEL, mtime=0)
+
+def compress_cached(data, encoding):
+    global _compress_cache_bytes
+    if len(data) > COMPRESS_CACHE_MAX_BODY:
+        return compress_bytes(data, encoding)
+    key = (encoding, hashlib.sha1(data).digest())
+    with _compress_cache_lock:
+        body = _compress_cache.get(key)
+        if body is not None:
+            _compress_cache.move_to_end(key)
+            return body
+    body = compress_bytes(data, encoding)
+    with _compress_cache_lock:
+        if key not in _compress_cache:
+            _compress_cache[key] = body
+            _compress_cache_bytes += len(body)
+            while _compress_cache_bytes > COMPRESS_CACHE_BYTES:
+                _, evicted = _compress_cache.popitem(last=False)
+                _compress_cache_bytes -= len(evicted)
+    return body
+
+def compress_stream(chunks, encoding):
+    # Flush after every chunk so streamed responses still arrive incrementally
+    if encoding == "br":
+        compressor = load_brotli().Compressor(quality=COMPRESS_BROTLI_QUALITY)
+        compress, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+        compress, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            out = compress(chunk) + flush()
+            if out:
+                yield out
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+def is_compressible(mimetype):
+    return mimetype in COMPRESSIBLE_MIMETYPES or (mimetype or "").endswith("+json")
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code < 200 or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers
+            or not is_compressible(response.mimetype)
+            or "no-transform" in response.headers.get('Cache-Control', "")):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+    if response.is_streamed or response.direct_passthrough:
+        response.response = compress_stream(response.response, encoding)
+        response.direct_passthrough = False
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        if response.cache_control.public or request.endpoint in COMPRESS_CACHE_ENDPOINTS:
+            response.set_data(compress_cached(data, encoding))
+        else:
+            response.set_data(compress_bytes(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def send_precompressed(directory, filename):
+    """Serve a file, using a .br/.gz sibling that is generated on first request."""
+    encoding = negotiate_encoding()
+    path = os.path.join(directory, secure_filename(filename))
+    if (encoding is None or os.path.splitext(filename)[1].lower() not in PRECOMPRESS_EXTENSIONS
+            or secure_filename(filename) != filename or not os.path.isfile(path)):
+        return send_from_directory(directory, filename)
+    suffix = ".br" if encoding == "br" else ".gz"
+    if not os.path.exists(path + suffix) or os.path.getmtime(path + suffix) < os.path.getmtime(path):
+        precompress_file(path, encoding)
+    response = send_from_directory(directory, filename + suffix,
+                                   mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+def precompress_file(path, encoding):
+    with open(path, "rb") as f:
+        data = f.read()
+    suffix = ".br" if encoding == "br" else ".gz"
+    # Write then rename so concurrent workers never serve a partial file
+    tmp = f"{path}{suffix}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(compress_bytes(data, encoding, best=True))
+    os.replace(tmp, path + suffix)
+
+@app.cli.command("precompress")
+def precompress_command():
+    """Generate .gz (and .br when brotli is installed) files for static assets and uploads."""
+    create_app()
+    encodings = ["gzip"] + (["br"] if load_brotli() else [])
+    for directory in (os.path.join(os.path.abspath(os.path.dirname(__file__)), "static"), app.config['UPLOAD_FOLDER']):
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and os.path.splitext(name)[1].lower() in PRECOMPRESS_EXTENSIONS:
+                for encoding in encodings:
+                    precompress_file(path, encoding)
+                print(f"Precompressed {path}")
+
 # ----------------------------
 # Routes
 # ----------------------------
 @app.route("/")
 def home():
-    return render_template_string(HOME_TEMPLATE)
+    return render_template("home.html", schools=list(SCHOOLS.values()))
 
 @app.route("/<role>_register", methods=["GET", "POST"])
 def register(role):
     if role not in ["parent", "driver"]:
-        return render_template_string(ERROR_TEMPLATE, code=404, message="Invalid role")
+        return render_template("error.html", code=404, message="Invalid role")
     
     table = f"{role}s"
     if request.method == "POST":
@@ -666,58 +2192,67 @@ def register(role):
             if cur.fetchone():
                 flash("Username already exists.", "danger")
             else:
-                hashed = generate_password_hash(password)
+                try:
+                    hashed = hash_password(password)
+                except LoginThrottled:
+                    flash("The server is busy. Please try again shortly.", "warning")
+                    return render_template("register.html", role=role), 429
                 photo_path = DEFAULT_PROFILE_IMG
                 if photo and allowed_file(photo.filename):
                     fname = secure_filename(photo.filename)
                     photo_path = os.path.join("uploads", fname)
                     photo.save(os.path.join(app.config['UPLOAD_FOLDER'], fname))
                 
-                db.execute(f"INSERT INTO {table} (name, username, password, phone, photo) VALUES (?, ?, ?, ?, ?)",
-                            (name, username, hashed, phone, photo_path))
+                cur = db.execute(f"INSERT INTO {table} (name, username, password, phone, photo) VALUES (?, ?, ?, ?, ?)",
+                                 (name, username, hashed, phone, photo_path))
                 db.commit()
+                invalidate_profile(table, cur.lastrowid)
+                invalidate_dashboard(table, cur.lastrowid)
                 flash("Registration successful. You can log in.", "success")
                 return redirect(url_for("login", role=role))
     
-    return render_template_string(REGISTER_TEMPLATE, role=role)
+    return render_template("register.html", role=role)
 
 @app.route("/<role>_login", methods=["GET", "POST"])
 def login(role):
     if role not in ["parent", "driver"]:
-        return render_template_string(ERROR_TEMPLATE, code=404, message="Invalid role")
+        return render_template("error.html", code=404, message="Invalid role")
         
     table = f"{role}s"
     
     if request.method == "POST":
         username = request.form.get("username", "").strip()
         password = request.form.get("password", "")
-        db = get_db()
-        cur = db.execute(f"SELECT id, password FROM {table} WHERE username = ?", (username,))
-        row = cur.fetchone()
-        
-        if row and check_password_hash(row["password"], password):
-            session['user_id'] = row["id"]
+        try:
+            user_id = authenticate(table, username, password)
+        except LoginThrottled as e:
+            return throttled_login_response(role, e)
+
+        if user_id:
+            session['user_id'] = user_id
             session['role'] = table
             flash(f"Welcome, {username}!", "success")
             return redirect(url_for(f"{role}_dashboard"))
         flash("Invalid username or password.", "danger")
     
-    return render_template_string(LOGIN_TEMPLATE, role=role)
+    return render_template("login.html", role=role)
 
 @app.route("/admin_login", methods=["GET", "POST"])
 def admin_login():
     if request.method == "POST":
-        username = request.form.get("username")
-        password = request.form.get("password")
-        db = get_db()
-        user = db.execute("SELECT id, password FROM users WHERE username = ? AND role = 'admin'", (username,)).fetchone()
-        if user and check_password_hash(user['password'], password):
-            session['user_id'] = user['id']
+        username = request.form.get("username", "")
+        password = request.form.get("password", "")
+        try:
+            user_id = authenticate("users", username, password, " AND role = 'admin'")
+        except LoginThrottled as e:
+            return throttled_login_response('admin', e)
+        if user_id:
+            session['user_id'] = user_id
             session['role'] = 'admin'
             flash("Logged in as Admin.", "success")
             return redirect(url_for('admin_dashboard'))
         flash("Invalid credentials.", "danger")
-    return render_template_string(LOGIN_TEMPLATE, role='admin')
+    return render_template("login.html", role='admin')
 
 @app.route("/edit_profile", methods=["GET", "POST"])
 @login_required()
@@ -744,11 +2279,19 @@ def edit_profile():
             db.execute(f"UPDATE {role} SET name = ?, phone = ?, photo = ? WHERE id = ?",
                        (name, phone, photo_path, user_id))
             db.commit()
+            invalidate_profile(role, user_id)
+            # Names and phones also appear on the dashboards of the other side of each child
+            if role == "parents":
+                for c in db.execute("SELECT DISTINCT driver_id FROM children WHERE parent_id = ?", (user_id,)):
+                    invalidate_dashboard("drivers", c['driver_id'])
+            elif role == "drivers":
+                for c in db.execute("SELECT DISTINCT parent_id FROM children WHERE driver_id = ?", (user_id,)):
+                    invalidate_dashboard("parents", c['parent_id'])
             flash("Profile updated successfully!", "success")
             return redirect(url_for("edit_profile"))
 
     photo_url = url_for("uploaded_file", filename=os.path.basename(user['photo'])) if "uploads/" in user['photo'] else url_for('static', filename=os.path.basename(user['photo']))
-    return render_template_string(EDIT_PROFILE_TEMPLATE, user=user, photo_url=photo_url)
+    return render_template("edit_profile.html", user=user, photo_url=photo_url)
 
 # ----------------------------
 # Dashboards (protected)
@@ -757,15 +2300,20 @@ def edit_profile():
 @login_required(role="parents")
 def parent_dashboard():
     user = get_user_data("parents", session.get('user_id'))
+    data = dashboard_cache.get_or_load((g.school, "parents", user['id']), lambda: load_parent_dashboard(user['id']),
+                                       user_cache_version("parents", user['id']))
+
+    photo_url = url_for("uploaded_file", filename=os.path.basename(user['photo'])) if "uploads/" in user['photo'] else url_for('static', filename=os.path.basename(user['photo']))
+    return render_template("parent_dashboard.html", user=user, children=data['children'], photo_url=photo_url)
+
+def load_parent_dashboard(parent_id):
     db = get_db()
     children_cur = db.execute("""
         SELECT c.name, c.class_name, d.name AS driver_name
         FROM children c JOIN drivers d ON c.driver_id = d.id
         WHERE c.parent_id = ?
-    """, (user['id'],)).fetchall()
-    
-    photo_url = url_for("uploaded_file", filename=os.path.basename(user['photo'])) if "uploads/" in user['photo'] else url_for('static', filename=os.path.basename(user['photo']))
-    return render_template_string(PARENT_DASHBOARD_TEMPLATE, user=user, children=children_cur, photo_url=photo_url)
+    """, (parent_id,)).fetchall()
+    return {'children': [dict(c) for c in children_cur]}
 
 @app.route("/add_child", methods=["GET", "POST"])
 @login_required(role="parents")
@@ -781,20 +2329,28 @@ def add_child():
             db.execute("INSERT INTO children (name, class_name, parent_id, driver_id) VALUES (?, ?, ?, ?)",
                        (name, class_name, session['user_id'], driver_id))
             db.commit()
+            invalidate_dashboard("parents", session['user_id'])
+            invalidate_dashboard("drivers", driver_id)
             flash("Child profile added successfully!", "success")
             return redirect(url_for('parent_dashboard'))
     
     drivers = db.execute("SELECT id, name FROM drivers").fetchall()
-    return render_template_string(ADD_CHILD_TEMPLATE, drivers=drivers)
+    return render_template("add_child.html", drivers=drivers)
 
 @app.route("/driver_dashboard")
 @login_required(role="drivers")
 def driver_dashboard():
     user = get_user_data("drivers", session.get('user_id'))
-    
+    data = dashboard_cache.get_or_load((g.school, "drivers", user['id']), lambda: load_driver_dashboard(user['id']),
+                                       user_cache_version("drivers", user['id']))
+
+    photo_url = url_for("uploaded_file", filename=os.path.basename(user['photo'])) if "uploads/" in user['photo'] else url_for('static', filename=os.path.basename(user['photo']))
+    return render_template("driver_dashboard.html", user=user, photo_url=photo_url, rating=data['rating'], total_ratings=data['total_ratings'], children=data['children'], default_report_s=REPORT_INTERVAL_IDLE_S)
+
+def load_driver_dashboard(driver_id):
     # Calculate average rating
     db = get_db()
-    cur = db.execute("SELECT AVG(rating) as avg_rating, COUNT(*) as total_ratings FROM feedback WHERE driver_id = ?", (user['id'],))
+    cur = db.execute("SELECT AVG(rating) as avg_rating, COUNT(*) as total_ratings FROM feedback WHERE driver_id = ?", (driver_id,))
     result = cur.fetchone()
     rating = result['avg_rating']
     total_ratings = result['total_ratings']
@@ -804,8 +2360,8 @@ def driver_dashboard():
         SELECT c.name AS child_name, p.name AS parent_name, p.phone AS parent_phone
         FROM children c JOIN parents p ON c.parent_id = p.id
         WHERE c.driver_id = ?
-    """, (user['id'],)).fetchall()
-    
+    """, (driver_id,)).fetchall()
+
     children = []
     for c in children_cur:
         message = f"Hi {c['parent_name']}, the bus has arrived at {c['child_name']}'s stop. Have a great day!"
@@ -814,9 +2370,7 @@ def driver_dashboard():
             'child_name': c['child_name'],
             'wa_link': wa_link
         })
-
-    photo_url = url_for("uploaded_file", filename=os.path.basename(user['photo'])) if "uploads/" in user['photo'] else url_for('static', filename=os.path.basename(user['photo']))
-    return render_template_string(DRIVER_DASHBOARD_TEMPLATE, user=user, photo_url=photo_url, rating=rating, total_ratings=total_ratings, children=children)
+    return {'rating': rating, 'total_ratings': total_ratings, 'children': children}
 
 @app.route("/admin_dashboard")
 @login_required(role="admin")
@@ -829,7 +2383,7 @@ def admin_dashboard():
         JOIN drivers d ON c.driver_id = d.id
         ORDER BY c.timestamp DESC
     """).fetchall()
-    return render_template_string(ADMIN_DASHBOARD_TEMPLATE, complaints=complaints_cur)
+    return render_template("admin_dashboard.html", complaints=complaints_cur)
 
 # ----------------------------
 # Bus Map and API
@@ -840,38 +2394,34 @@ def bus_map():
     db = get_db()
     cur = db.execute("SELECT id, name, lat, lon FROM drivers WHERE lat IS NOT NULL AND lon IS NOT NULL")
     drivers = cur.fetchall()
-    return render_template_string(BUS_MAP_TEMPLATE, drivers=drivers, school_lat=SCHOOL_LOCATION['lat'], school_lon=SCHOOL_LOCATION['lon'], bus_near_distance_km=BUS_NEAR_DISTANCE_KM)
+    school = current_school()
+    return render_template("bus_map.html", drivers=drivers, school_lat=school['location']['lat'], school_lon=school['location']['lon'], bus_near_distance_km=school['bus_near_distance_km'])
 
 @app.route("/bus_locations")
 @login_required(role="parents")
 def bus_locations():
-    db = get_db()
-    cur = db.execute("SELECT id, name, phone, photo, lat, lon, last_updated FROM drivers WHERE lat IS NOT NULL AND lon IS NOT NULL")
-    drivers = cur.fetchall()
-    
-    locations = []
-    for driver in drivers:
-        photo_url = url_for("uploaded_file", filename=os.path.basename(driver['photo'])) if "uploads/" in driver['photo'] else url_for('static', filename=os.path.basename(driver['photo']))
-        
-        distance = calculate_distance(driver['lat'], driver['lon'], SCHOOL_LOCATION['lat'], SCHOOL_LOCATION['lon'])
-        eta_minutes = int((distance / AVERAGE_BUS_SPEED_KMPH) * 60)
-        
-        eta_string = f"{eta_minutes} mins" if eta_minutes > 0 else "Arrived!"
-
-        cur_rating = db.execute("SELECT AVG(rating) as avg_rating FROM feedback WHERE driver_id = ?", (driver['id'],)).fetchone()['avg_rating']
-
-        locations.append({
-            'id': driver['id'],
-            'name': driver['name'],
-            'phone': driver['phone'],
-            'photo': request.host_url.rstrip('/') + photo_url,
-            'lat': driver['lat'],
-            'lon': driver['lon'],
-            'rating': cur_rating,
-            'eta': eta_string,
-            'last_updated': driver['last_updated']
-        })
-    return jsonify(drivers=locations)
+    key = (g.school, public_base_url())
+    snapshot = fleet_cache.get(key, build_fleet_snapshot)
+    compressed = request.accept_encodings.quality('gzip') > 0
+    formats = {'json': FLEET_JSON_MIMETYPE, 'columnar': FLEET_COLUMNAR_MIMETYPE, 'binary': FLEET_BINARY_MIMETYPE}
+    mimetype = formats.get(request.args.get('format')) or request.accept_mimetypes.best_match(
+        [FLEET_JSON_MIMETYPE, FLEET_COLUMNAR_MIMETYPE, FLEET_BINARY_MIMETYPE], default=FLEET_JSON_MIMETYPE)
+
+    if mimetype == FLEET_JSON_MIMETYPE:
+        body = snapshot['json_gzip'] if compressed else snapshot['json']
+        etag = snapshot['etag']
+    else:
+        # Clients pass back the static_version they hold to skip the static columns
+        include_static = request.args.get('static') != snapshot['static_version']
+        body, etag = encoded_fleet(snapshot, mimetype, include_static, compressed)
+
+    response = app.response_class(body, mimetype=mimetype)
+    if compressed:
+        response.headers['Content-Encoding'] = "gzip"
+    response.headers['Vary'] = "Accept, Accept-Encoding"
+    response.headers['Cache-Control'] = f"private, max-age={FLEET_CACHE_TTL_S}"
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 @app.route("/update_location", methods=["POST"])
 @login_required(role="drivers")
@@ -884,14 +2434,114 @@ def update_location():
         if lat is None or lon is None:
             return jsonify({'status': 'error', 'message': 'Missing latitude or longitude'}), 400
 
+        lat, lon = float(lat), float(lon)
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            return jsonify({'status': 'error', 'message': 'Latitude or longitude out of range'}), 400
+
         user_id = session.get('user_id')
+        # Optional Geolocation API extras: position.timestamp (ms) and coords.accuracy (m)
+        timestamp = data.get('timestamp')
+        school = current_school()
+        verdict, lat, lon = filter_fix((school['slug'], user_id), lat, lon,
+                                       timestamp=timestamp / 1000.0 if timestamp else None,
+                                       accuracy=data.get('accuracy'))
+        next_report_s = next_report_interval((school['slug'], user_id), lat, lon, school)
+        if verdict == 'rejected_speed':
+            return jsonify({'status': 'success', 'accepted': False, 'message': 'Location ignored (GPS jump)', 'next_report_s': next_report_s})
+        if verdict != 'accepted':
+            return jsonify({'status': 'success', 'accepted': False, 'message': 'Location unchanged', 'next_report_s': next_report_s})
+
         db = get_db()
         db.execute("UPDATE drivers SET lat = ?, lon = ?, last_updated = datetime('now') WHERE id = ?", (lat, lon, user_id))
+        db.execute("INSERT INTO locations (driver_id, lat, lon, recorded_at) VALUES (?, ?, ?, datetime('now'))", (user_id, lat, lon))
         db.commit()
-        return jsonify({'status': 'success', 'message': 'Location updated'})
+        return jsonify({'status': 'success', 'accepted': True, 'message': 'Location updated', 'next_report_s': next_report_s})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route("/notify_arrival", methods=["POST"])
+@login_required(role="drivers")
+def notify_arrival():
+    if not get_transport():
+        return jsonify({'status': 'error', 'message': 'Parent notifications are not configured on this server.'}), 503
+    queued = enqueue_arrival_notifications(session.get('user_id'))
+    if queued:
+        return jsonify({'status': 'success', 'queued': queued, 'message': f"Notifying {queued} parent(s)."})
+    return jsonify({'status': 'success', 'queued': 0, 'message': "Parents have already been notified."})
+
+@app.route("/admin/punctuality")
+@login_required(role="admin")
+def punctuality():
+    month = request.args.get('month') or datetime.now(timezone.utc).strftime("%Y-%m")
+    if not re.fullmatch(r"\d{4}-\d{2}", month):
+        return jsonify({'status': 'error', 'message': 'month must be YYYY-MM'}), 400
+    db = get_db()
+    summary = db.execute("""
+        SELECT r.driver_id, d.name AS driver_name, COUNT(*) AS days,
+               AVG(r.late_minutes) AS avg_late_minutes,
+               SUM(CASE WHEN r.late_minutes <= ? THEN 1 ELSE 0 END) AS on_time_days,
+               SUM(r.distance_km) AS distance_km, SUM(r.trips) AS trips,
+               AVG(r.dwell_minutes) AS avg_dwell_minutes
+        FROM daily_rollups r JOIN drivers d ON d.id = r.driver_id
+        WHERE r.day LIKE ? || '-%'
+        GROUP BY r.driver_id ORDER BY avg_late_minutes DESC
+    """, (ON_TIME_GRACE_MIN, month)).fetchall()
+    result = {'month': month, 'drivers': [dict(r) for r in summary]}
+    driver_id = request.args.get('driver_id', type=int)
+    if driver_id:
+        days = db.execute("SELECT * FROM daily_rollups WHERE driver_id = ? AND day LIKE ? || '-%' ORDER BY day",
+                          (driver_id, month)).fetchall()
+        result['days'] = [dict(r) for r in days]
+    return jsonify(result)
+
+@app.route("/admin/archive/<table>")
+@login_required(role="admin")
+def archived_rows(table):
+    if table not in RETENTION_DAYS:
+        return jsonify({'status': 'error', 'message': 'Unknown table'}), 404
+    start, end = request.args.get('start', ''), request.args.get('end', '')
+    try:
+        datetime.strptime(start, "%Y-%m-%d")
+        datetime.strptime(end, "%Y-%m-%d")
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'start and end must be YYYY-MM-DD'}), 400
+    # Streamed as JSON lines so months of history never sit in memory
+    rows = read_archive(g.school, table, start, end)
+    return app.response_class((json.dumps(row) + "\n" for row in rows), mimetype="application/x-ndjson")
+
+@app.route("/admin/auth_stats")
+@login_required(role="admin")
+def auth_stats():
+    with _login_attempts_lock:
+        stats = dict(AUTH_STATS)
+    jobs = stats['verifications'] + stats['hashes']
+    stats['hash_seconds_avg'] = round(stats['hash_seconds_total'] / jobs, 4) if jobs else 0.0
+    stats['hash_method'] = PASSWORD_HASH_METHOD
+    stats['workers'] = LOGIN_HASH_WORKERS
+    stats['queue_limit'] = LOGIN_HASH_QUEUE
+    return jsonify(stats)
+
+@app.route("/admin/ingest_stats")
+@login_required(role="admin")
+def ingest_stats():
+    with _ingest_lock:
+        stats = dict(INGEST_STATS)
+    dropped = stats['received'] - stats['accepted']
+    stats['drop_ratio'] = round(dropped / stats['received'], 3) if stats['received'] else 0.0
+    return jsonify(stats)
+
+@app.route("/track/<int:driver_id>")
+@login_required()
+def track(driver_id):
+    local_now = datetime.now(timezone.utc) + timedelta(minutes=current_school()['utc_offset_min'])
+    day = request.args.get('date') or local_now.strftime("%Y-%m-%d")
+    try:
+        datetime.strptime(day, "%Y-%m-%d")
+        zoom = min(max(int(request.args.get('zoom', TRACK_DEFAULT_ZOOM)), 0), 20)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid date or zoom'}), 400
+    return jsonify(get_simplified_track(driver_id, day, zoom))
+
 # ----------------------------
 # Feedback and Complaints
 # ----------------------------
@@ -907,10 +2557,13 @@ def feedback():
 
         if not all([driver_id, rating]):
             flash("Please select a driver and a rating.", "danger")
+        elif rating not in ("1", "2", "3", "4", "5"):
+            flash("Rating must be between 1 and 5.", "danger")
         else:
             db.execute("INSERT INTO feedback (parent_id, driver_id, rating, message, timestamp) VALUES (?, ?, ?, ?, datetime('now'))",
                         (session['user_id'], driver_id, rating, message))
             db.commit()
+            invalidate_dashboard("drivers", driver_id)
             flash("Thank you for your feedback!", "success")
             return redirect(url_for('feedback'))
 
@@ -922,7 +2575,7 @@ def feedback():
         WHERE f.parent_id = ? ORDER BY f.timestamp DESC
     """, (session['user_id'],)).fetchall()
 
-    return render_template_string(FEEDBACK_TEMPLATE, drivers=drivers_cur, past_feedback=past_feedback_cur)
+    return render_template("feedback.html", drivers=drivers_cur, past_feedback=past_feedback_cur)
 
 @app.route("/submit_complaint", methods=["GET", "POST"])
 @login_required(role="parents")
@@ -941,7 +2594,7 @@ def submit_complaint():
             return redirect(url_for('parent_dashboard'))
     
     drivers_cur = db.execute("SELECT id, name FROM drivers ORDER BY name").fetchall()
-    return render_template_string(COMPLAINTS_TEMPLATE, drivers=drivers_cur)
+    return render_template("complaints.html", drivers=drivers_cur)
 
 
 # ----------------------------
@@ -949,36 +2602,39 @@ def submit_complaint():
 # ----------------------------
 @app.route("/logout")
 def logout():
+    school = session.get('school')
     session.clear()
+    if school:
+        session['school'] = school
     flash("You have been logged out.", "info")
     return redirect(url_for("home"))
 
 @app.route("/uploads/<filename>")
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_precompressed(app.config['UPLOAD_FOLDER'], filename)
 
-@app.route("/static/<filename>")
+@app.route("/static/<filename>", endpoint="static")
 def static_file(filename):
-    return send_from_directory(os.path.join(os.path.abspath(os.path.dirname(__file__)), "static"), filename)
+    return send_precompressed(os.path.join(os.path.abspath(os.path.dirname(__file__)), "static"), filename)
 
 # ----------------------------
 # Error handling
 # ----------------------------
 @app.errorhandler(413)
 def request_entity_too_large(error):
-    return render_template_string(ERROR_TEMPLATE, code=413, message="File too large."), 413
+    return render_template("error.html", code=413, message="File too large."), 413
 
 @app.errorhandler(404)
 def not_found(error):
-    return render_template_string(ERROR_TEMPLATE, code=404, message="Page not found."), 404
+    return render_template("error.html", code=404, message="Page not found."), 404
 
 @app.errorhandler(500)
 def internal_error(error):
     logging.exception("Server error: %s", error)
-    return render_template_string(ERROR_TEMPLATE, code=500, message="Server error. Please try again later."), 500
+    return render_template("error.html", code=500, message="Server error. Please try again later."), 500
 
 # ----------------------------
 # Run
 # ----------------------------
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    create_app().run(host="0.0.0.0", port=5000, debug=True)
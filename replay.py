@@ -0,0 +1,239 @@
+"""Replay recorded GPS traces through update_location and measure freshness.
+
+Each bus logs in as a driver and posts its fixes with the original spacing
+divided by --speed. A parent session polls bus_locations and records how long
+each accepted fix takes to become visible there.
+
+Traces are CSV files with bus,timestamp,lat,lon columns (bus is the driver
+username; timestamp is ISO 8601 or epoch seconds) or GPX files, one bus per
+file, named after the file or its <trk><name>.
+
+Usage:
+    python replay.py traces/*.csv --url http://localhost:5000 --speed 20
+    python replay.py traces/*.gpx --in-process --register --speed 100
+
+Against a live server, start it with LOGIN_RATE_LIMIT_IP raised above the
+number of buses, and leave INGEST_SMOOTHING off so stored coordinates match
+the trace. Fixes are stamped with the replay's wall-clock time, so the ingest
+filter sees buses moving --speed times faster: raise INGEST_MAX_SPEED_KMPH by
+the same factor (in-process runs read it from the environment too).
+"""
+import argparse, csv, json, os, statistics, threading, time
+import http.cookiejar, urllib.error, urllib.parse, urllib.request
+import xml.etree.ElementTree as ET
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+GPX_NS = {'gpx': "http://www.topografix.com/GPX/1/1"}
+
+# ----------------------------
+# Trace loading
+# ----------------------------
+def parse_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return parsed.timestamp()
+
+def load_csv(path):
+    traces = defaultdict(list)
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            traces[row['bus']].append((parse_time(row['timestamp']), float(row['lat']), float(row['lon'])))
+    return traces
+
+def load_gpx(path):
+    root = ET.parse(path).getroot()
+    # Accept both GPX 1.1 and un-namespaced files
+    ns = GPX_NS if root.tag.startswith("{") else {}
+    prefix = "gpx:" if ns else ""
+    name = root.find(f"{prefix}trk/{prefix}name", ns)
+    bus = name.text.strip() if name is not None and name.text else os.path.splitext(os.path.basename(path))[0]
+    points = []
+    for pt in root.iter(f"{{{GPX_NS['gpx']}}}trkpt" if ns else "trkpt"):
+        when = pt.find(f"{prefix}time", ns)
+        if when is not None:
+            points.append((parse_time(when.text), float(pt.get('lat')), float(pt.get('lon'))))
+    return {bus: points}
+
+def load_traces(paths):
+    traces = defaultdict(list)
+    for path in paths:
+        loaded = load_gpx(path) if path.lower().endswith(".gpx") else load_csv(path)
+        for bus, points in loaded.items():
+            traces[bus].extend(points)
+    return {bus: sorted(points) for bus, points in traces.items()}
+
+# ----------------------------
+# Clients
+# ----------------------------
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    # Login success is recognised by its 302, so redirects are not followed
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+class HttpClient:
+    def __init__(self, base_url, school=None):
+        self.base_url = base_url.rstrip("/")
+        self.school = school
+        self.opener = urllib.request.build_opener(NoRedirect(), urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def _request(self, path, data=None, headers=None):
+        headers = dict(headers or {})
+        if self.school:
+            headers['X-School'] = self.school
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers)
+        try:
+            with self.opener.open(req, timeout=30) as resp:
+                return resp.status, resp.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def post_form(self, path, fields):
+        return self._request(path, urllib.parse.urlencode(fields).encode())[0]
+
+    def post_json(self, path, payload):
+        status, body = self._request(path, json.dumps(payload).encode(), {'Content-Type': "application/json"})
+        return status, json.loads(body or b"{}")
+
+    def get_json(self, path):
+        status, body = self._request(path, headers={'Accept': "application/json"})
+        return json.loads(body) if status == 200 else None
+
+class InProcessClient:
+    """Drives the Flask app directly, without a server or network."""
+    def __init__(self, school=None):
+        from main import create_app
+        self.client = create_app().test_client()
+        self.headers = {'X-School': school} if school else {}
+
+    def post_form(self, path, fields):
+        return self.client.post(path, data=fields, headers=self.headers).status_code
+
+    def post_json(self, path, payload):
+        resp = self.client.post(path, json=payload, headers=self.headers)
+        return resp.status_code, resp.get_json(silent=True) or {}
+
+    def get_json(self, path):
+        resp = self.client.get(path, headers=self.headers)
+        return resp.get_json() if resp.status_code == 200 else None
+
+# ----------------------------
+# Replay
+# ----------------------------
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}  # (lat, lon) -> time the fix was posted
+        self.freshness = []
+        self.ingest = []
+        self.counts = defaultdict(int)
+
+    def posted(self, lat, lon, sent_at, elapsed, accepted):
+        with self.lock:
+            self.ingest.append(elapsed)
+            self.counts['posted'] += 1
+            if accepted:
+                self.counts['accepted'] += 1
+                self.pending[(round(lat, 6), round(lon, 6))] = sent_at
+
+    def seen(self, lat, lon, seen_at):
+        with self.lock:
+            sent_at = self.pending.pop((round(lat, 6), round(lon, 6)), None)
+            if sent_at is not None:
+                self.freshness.append(seen_at - sent_at)
+
+def replay_bus(make_client, bus, points, password, speed, start, recorder, register):
+    client = make_client()
+    if register:
+        client.post_form("/driver_register", {'name': bus, 'username': bus, 'password': password, 'phone': "0"})
+    if client.post_form("/driver_login", {'username': bus, 'password': password}) != 302:
+        with recorder.lock:
+            recorder.counts['login_failed'] += 1
+        return
+    t0 = points[0][0]
+    for ts, lat, lon in points:
+        delay = start + (ts - t0) / speed - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        sent_at = time.time()
+        # Trace times are rebased onto the wall clock so repeated runs against one
+        # server never look out of order to the ingest filter
+        status, data = client.post_json("/update_location",
+                                        {'lat': lat, 'lon': lon, 'timestamp': (start + (ts - t0) / speed) * 1000})
+        recorder.posted(lat, lon, sent_at, time.time() - sent_at, status == 200 and data.get('accepted'))
+        if status != 200:
+            with recorder.lock:
+                recorder.counts[f"http_{status}"] += 1
+
+def poll_fleet(client, recorder, interval, stop):
+    while not stop.is_set():
+        data = client.get_json("/bus_locations?format=json")
+        now = time.time()
+        for driver in (data or {}).get('drivers', []):
+            recorder.seen(driver['lat'], driver['lon'], now)
+        stop.wait(interval)
+
+def percentiles(values):
+    if not values:
+        return "n/a"
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000
+    return (f"p50 {pick(0.5):.0f} ms, p90 {pick(0.9):.0f} ms, p99 {pick(0.99):.0f} ms, "
+            f"max {ordered[-1] * 1000:.0f} ms, mean {statistics.mean(ordered) * 1000:.0f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay GPS traces through update_location and measure freshness.")
+    parser.add_argument("traces", nargs="+", help="CSV or GPX trace files")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="base URL of a running server")
+    target.add_argument("--in-process", action="store_true", help="drive main.app directly")
+    parser.add_argument("--school", help="school id to replay into")
+    parser.add_argument("--speed", type=float, default=1.0, help="speed-up factor, 1 (real time) to 100")
+    parser.add_argument("--password", default="pass", help="password of every replayed driver")
+    parser.add_argument("--register", action="store_true", help="register missing driver accounts first")
+    parser.add_argument("--parent-user", default="parent1")
+    parser.add_argument("--parent-password", default="pass")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="seconds between bus_locations polls")
+    args = parser.parse_args()
+    if not 1 <= args.speed <= 100:
+        parser.error("--speed must be between 1 and 100")
+
+    traces = {bus: points for bus, points in load_traces(args.traces).items() if points}
+    if not traces:
+        parser.error("no fixes found in the given traces")
+    make_client = (lambda: InProcessClient(args.school)) if args.in_process else (lambda: HttpClient(args.url, args.school))
+
+    parent = make_client()
+    if parent.post_form("/parent_login", {'username': args.parent_user, 'password': args.parent_password}) != 302:
+        parser.error("parent login failed")
+
+    recorder = Recorder()
+    stop = threading.Event()
+    poller = threading.Thread(target=poll_fleet, args=(parent, recorder, args.poll_interval, stop), daemon=True)
+    poller.start()
+
+    start = time.time() + 1.0
+    print(f"Replaying {sum(len(p) for p in traces.values())} fixes from {len(traces)} buses at {args.speed:g}x")
+    with ThreadPoolExecutor(max_workers=len(traces)) as pool:
+        futures = [pool.submit(replay_bus, make_client, bus, points, args.password, args.speed, start, recorder, args.register)
+                   for bus, points in traces.items()]
+        for future in futures:
+            future.result()
+    # Give the last fixes a chance to show up in bus_locations
+    time.sleep(max(args.poll_interval * 4, 3))
+    stop.set()
+    poller.join()
+
+    print(f"Wall time: {time.time() - start:.1f} s")
+    print("Counts: " + ", ".join(f"{k} {v}" for k, v in sorted(recorder.counts.items())))
+    print(f"Ingest latency:    {percentiles(recorder.ingest)}")
+    print(f"Freshness latency: {percentiles(recorder.freshness)} ({len(recorder.freshness)} fixes observed)")
+    print(f"Never observed (superseded before a poll): {len(recorder.pending)}")
+
+if __name__ == "__main__":
+    main()